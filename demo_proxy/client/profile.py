@@ -0,0 +1,78 @@
+"""Command line for profiling the running DemoProxy processes."""
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from demo_proxy import cli
+from demo_proxy.client import server
+from demo_proxy.client import worker
+from demo_proxy.common import exception
+from demo_proxy.common import profiler
+
+PID_FILES = {
+    "server": server.PID_FILE,
+    "worker": worker.PID_FILE,
+}
+
+
+class Profile(cli.Command):
+    """Profile the running DemoProxy server or worker."""
+
+    def setup(self):
+        """Extend the parser configuration in order to expose this command."""
+        parser = self._parser.add_parser(
+            "profile",
+            help="Sample the stacks of the running server or worker "
+                 "and print them in the collapsed (flame graph) format.")
+        parser.add_argument(
+            "component", choices=sorted(PID_FILES),
+            help="The processes that should be profiled."
+        )
+        parser.add_argument(
+            "--seconds", type=float, default=10,
+            help="How long the processes are profiled. Default: 10"
+        )
+        parser.add_argument(
+            "--output", type=str, default=None,
+            help="The file where the samples are written. Default: stdout"
+        )
+        parser.set_defaults(work=self.run)
+
+    def _signal(self, component):
+        """Ask the running processes to start profiling."""
+        try:
+            with open(PID_FILES[component], "r") as file_handle:
+                pid = int(file_handle.read().strip())
+        except (ValueError, IOError, OSError):
+            raise exception.NotFound("Failed to get the %s PID." % component)
+
+        with open(profiler.control_file(component), "w") as file_handle:
+            json.dump({"seconds": self.args.seconds}, file_handle)
+        os.kill(pid, profiler.SIGNAL)
+
+    def _work(self):
+        """Profile the running processes and print the samples."""
+        component = self.args.component
+        started = time.time()
+        self._signal(component)
+
+        # Wait a bit longer for the processes to dump their samples
+        time.sleep(self.args.seconds)
+        deadline = time.time() + 5
+        samples = profiler.collect(component, started)
+        while not samples and time.time() < deadline:
+            time.sleep(0.5)
+            samples = profiler.collect(component, started)
+        if not samples:
+            raise exception.NotFound("No samples received from the %s."
+                                     % component)
+
+        lines = ["%s %d" % item for item in sorted(samples.items())]
+        if self.args.output:
+            with open(self.args.output, "w") as file_handle:
+                file_handle.write("\n".join(lines) + "\n")
+        else:
+            print("\n".join(lines))
+        return True
@@ -6,9 +6,8 @@ from tempfile import gettempdir
 import multiprocessing
 
 from demo_proxy import cli
+from demo_proxy.common import codec
 from demo_proxy.common import exception
-from demo_proxy.common import queue as demo_proxy_queue
-from demo_proxy import wsd
 
 PID_FILE = os.path.join(gettempdir(), "demo-proxy-server.pid")
 
@@ -58,20 +57,189 @@ class _Start(cli.Command):
             default=int(os.environ.get("PROXY_REDIS_DATABASE", 0)),
             help="The Redis database that should be used. Default: 0"
         )
+        parser.add_argument(
+            "--compression", type=str,
+            choices=sorted(codec.ALGORITHMS),
+            default=os.environ.get("PROXY_COMPRESSION"),
+            help="The algorithm used for compressing the large payloads "
+                 "stored in Redis. Default: no compression"
+        )
+        parser.add_argument(
+            "--compression-threshold", type=int,
+            default=int(os.environ.get("PROXY_COMPRESSION_THRESHOLD", 1024)),
+            help="The minimum size (in bytes) of a compressed payload. "
+                 "Default: 1024"
+        )
+        parser.add_argument(
+            "--max-queue-depth", type=int,
+            default=int(os.environ.get("PROXY_MAX_QUEUE_DEPTH", 1000)),
+            help="Reject new requests when there are more requests "
+                 "waiting in their lane and in the lanes served before "
+                 "it. Default: 1000"
+        )
+        parser.add_argument(
+            "--target-queue-wait", type=float,
+            default=float(os.environ.get("PROXY_TARGET_QUEUE_WAIT", 0.5)),
+            help="Start shedding load when the requests wait in queue "
+                 "longer than this (in seconds). Default: 0.5"
+        )
+        parser.add_argument(
+            "--admission-interval", type=float,
+            default=float(os.environ.get("PROXY_ADMISSION_INTERVAL", 1)),
+            help="How long (in seconds) the queue wait should stay above "
+                 "the target before shedding load. Default: 1"
+        )
+        parser.add_argument(
+            "--tenant-header", type=str,
+            default=os.environ.get("PROXY_TENANT_HEADER", "X-Tenant"),
+            help="The header used for identifying the tenant. When missing, "
+                 "the first segment of the path is used. Default: X-Tenant"
+        )
+        parser.add_argument(
+            "--priority-header", type=str,
+            default=os.environ.get("PROXY_PRIORITY_HEADER", "X-Priority"),
+            help="The header the clients can use for moving their requests "
+                 "to a lower priority lane (normal or low). Default: "
+                 "X-Priority"
+        )
+        parser.add_argument(
+            "--tenant-lane", type=str, action="append",
+            dest="tenant_lanes",
+            default=[item for item in os.environ.get(
+                "PROXY_TENANT_LANES", "").split(",") if item],
+            help="The priority lane of a tenant (high, normal or low), in "
+                 "the <tenant>=<lane> format. Can be used multiple times. "
+                 "Default lane: normal"
+        )
+        parser.add_argument(
+            "--client-rate", type=float,
+            default=float(os.environ.get("PROXY_CLIENT_RATE", 0)),
+            help="The number of requests per second allowed for a client. "
+                 "Default: 0 (unlimited)"
+        )
+        parser.add_argument(
+            "--client-burst", type=int,
+            default=int(os.environ.get("PROXY_CLIENT_BURST", 0)),
+            help="The number of requests a client can send in a burst. "
+                 "Default: the client rate (at least 1)"
+        )
+        parser.add_argument(
+            "--trusted-proxy", type=str, action="append",
+            dest="trusted_proxies",
+            default=[item for item in os.environ.get(
+                "PROXY_TRUSTED_PROXIES", "").split(",") if item],
+            help="The address of a proxy in front of the server, whose "
+                 "X-Forwarded-For entries identify the clients. Can be "
+                 "used multiple times. Default: the X-Forwarded-For header "
+                 "is ignored"
+        )
+        parser.add_argument(
+            "--route-rate", type=float,
+            default=float(os.environ.get("PROXY_ROUTE_RATE", 0)),
+            help="The number of requests per second allowed for a route. "
+                 "Default: 0 (unlimited)"
+        )
+        parser.add_argument(
+            "--route-burst", type=int,
+            default=int(os.environ.get("PROXY_ROUTE_BURST", 0)),
+            help="The number of requests a route can receive in a burst. "
+                 "Default: the route rate (at least 1)"
+        )
+        parser.add_argument(
+            "--reply-host", type=str,
+            default=os.environ.get("PROXY_REPLY_HOST"),
+            help="The IP address or the host name the workers can use for "
+                 "sending the responses directly to this server (the reply "
+                 "listener is bound to it). Default: responses are sent "
+                 "through Redis"
+        )
+        parser.add_argument(
+            "--compress-min-size", type=int,
+            default=int(os.environ.get("PROXY_COMPRESS_MIN_SIZE", 0)),
+            help="Compress (gzip) the uncompressed upstream responses larger "
+                 "than this for the clients accepting it. "
+                 "Default: 0 (disabled)"
+        )
+        parser.add_argument(
+            "--capture-dir", type=str,
+            default=os.environ.get("PROXY_CAPTURE_DIR"),
+            help="Record the incoming requests in this directory, in "
+                 "order to replay them later. Default: disabled"
+        )
+        parser.add_argument(
+            "--capture-max-bytes", type=int,
+            default=int(os.environ.get("PROXY_CAPTURE_MAX_BYTES", 67108864)),
+            help="The size of a capture log which triggers its rotation. "
+                 "Default: 67108864"
+        )
+        parser.add_argument(
+            "--capture-backups", type=int,
+            default=int(os.environ.get("PROXY_CAPTURE_BACKUPS", 5)),
+            help="How many rotated capture logs are kept for every "
+                 "server process. Default: 5"
+        )
+        parser.add_argument(
+            "--idempotency-ttl", type=int,
+            default=int(os.environ.get("PROXY_IDEMPOTENCY_TTL", 86400)),
+            help="For how many seconds the response of a request with an "
+                 "Idempotency-Key header is remembered for its retries. "
+                 "Default: 86400 (0 disables it)"
+        )
         parser.set_defaults(work=self.run)
 
+    @staticmethod
+    def _parse_lanes(values, lanes):
+        """Parse the <tenant>=<lane> items received."""
+        tenant_lanes = {}
+        for value in values:
+            tenant, _, lane = value.partition("=")
+            lane = lane.strip().lower()
+            if lane not in lanes:
+                raise exception.DemoProxyException(
+                    "Invalid tenant lane: %(value)r", value=value)
+            tenant_lanes[tenant.strip()] = lane
+        return tenant_lanes
+
     def _work(self):
         """Start the Demo-Proxy standalone application."""
+        # The heavy subsystems (gunicorn, requests, redis) are loaded only
+        # when they are actually required.
+        # pylint: disable=import-outside-toplevel
+        from demo_proxy.common import queue as demo_proxy_queue
+        from demo_proxy import wsd
+
         pid = os.getpid()
 
         with open(PID_FILE, "w") as file_handle:
             file_handle.write(str(pid))
 
+        payload_codec = codec.Codec(self.args.compression,
+                                    self.args.compression_threshold,
+                                    component="server")
         queue = demo_proxy_queue.RedisQueue(self.args.redis_host,
                                             self.args.redis_port,
-                                            self.args.redis_database)
+                                            self.args.redis_database,
+                                            payload_codec)
         web_server = wsd.DemoProxy(
             tasks_queue=queue,
+            max_depth=self.args.max_queue_depth,
+            target_wait=self.args.target_queue_wait,
+            admission_interval=self.args.admission_interval,
+            tenant_header=self.args.tenant_header,
+            priority_header=self.args.priority_header,
+            tenant_lanes=self._parse_lanes(self.args.tenant_lanes,
+                                           demo_proxy_queue.LANES),
+            client_rate=self.args.client_rate,
+            client_burst=self.args.client_burst,
+            route_rate=self.args.route_rate,
+            route_burst=self.args.route_burst,
+            trusted_proxies=self.args.trusted_proxies,
+            reply_host=self.args.reply_host,
+            compress_min_size=self.args.compress_min_size,
+            capture_dir=self.args.capture_dir,
+            capture_max_bytes=self.args.capture_max_bytes,
+            capture_backups=self.args.capture_backups,
+            idempotency_ttl=self.args.idempotency_ttl,
             bind="%s:%s" % (self.args.host, self.args.port),
             workers=self.args.workers)
         web_server.run()
@@ -0,0 +1,174 @@
+"""Command line group for inspecting the DemoProxy queue and workers."""
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from demo_proxy import cli
+
+
+class _StatsCommand(cli.Command):
+    """Common logic for the commands reading the queue statistics."""
+
+    # pylint: disable=abstract-method
+
+    @staticmethod
+    def _add_redis_arguments(parser):
+        """Add the arguments required for connecting to Redis."""
+        parser.add_argument(
+            "--redis-host", type=str,
+            default=os.environ.get("PROXY_REDIS_HOST", "redis"),
+            help="The IP address or the host name of the Redis Server. "
+                 "Default: redis"
+        )
+        parser.add_argument(
+            "--redis-port", type=int,
+            default=int(os.environ.get("PROXY_REDIS_PORT", 6379)),
+            help="The port that should be used for connecting to the"
+                 "Redis Database. Default: 6379"
+        )
+        parser.add_argument(
+            "--redis-database", type=int,
+            default=int(os.environ.get("PROXY_REDIS_DATABASE", 0)),
+            help="The Redis database that should be used. Default: 0"
+        )
+
+    def _queue(self):
+        """Connect to the remote queue."""
+        # The heavy subsystems are loaded only when they are required.
+        # pylint: disable=import-outside-toplevel
+        from demo_proxy.common import queue as demo_proxy_queue
+
+        return demo_proxy_queue.RedisQueue(self.args.redis_host,
+                                           self.args.redis_port,
+                                           self.args.redis_database)
+
+    @staticmethod
+    def _render(stats, rates=None):
+        """Format the statistics as a human readable report.
+
+        :param rates: the recent throughput of the workers (requests/s);
+                      by default the average since the worker started
+        """
+        # pylint: disable=too-many-locals
+        lines = ["Queue"]
+        for lane, tenants in sorted(stats["lanes"].items()):
+            lines.append("  %-8s %6d requests  %4d tenants" % (
+                lane, sum(tenants.values()), len(tenants)))
+            busiest = sorted(tenants.items(), key=lambda item: -item[1])
+            for tenant, depth in busiest[:5]:
+                lines.append("    %-24s %6d" % (tenant, depth))
+
+        responses = stats["responses"]
+        lines.append("Responses")
+        lines.append("  %-24s %6d" % ("response hash", responses["pending"]))
+        lines.append("  %-24s %6d (%d responses)" % (
+            "reply queues", len(responses["reply_queues"]),
+            sum(responses["reply_queues"].values())))
+
+        lines.append("Metrics")
+        for component, values in sorted(stats["metrics"].items()):
+            lines.append("  %s" % component)
+            for name, value in sorted(values.items()):
+                lines.append("    %-32s %12.6g" % (name, float(value)))
+
+        workers = stats["workers"]
+        lines.append("Workers (%d alive, %d requests in flight)" % (
+            len(workers), sum(int(values.get("in_flight", 0))
+                              for values in workers.values())))
+        lines.append("  %-32s %7s %9s %7s %9s %9s" % (
+            "worker", "threads", "in flight", "backlog", "processed",
+            "req/s"))
+        for worker, values in sorted(workers.items()):
+            processed = int(values.get("processed", 0))
+            rate = (rates or {}).get(worker)
+            if rate is None:
+                started_at = float(values.get("started_at", 0))
+                uptime = float(values.get("updated_at", 0)) - started_at
+                rate = processed / max(uptime, 1)
+            lines.append("  %-32s %7s %9s %7s %9d %9.1f" % (
+                worker, values.get("threads", "-"),
+                values.get("in_flight", "-"), values.get("backlog", "-"),
+                processed, rate))
+        return "\n".join(lines)
+
+
+class _Show(_StatsCommand):
+    """Show a snapshot of the queue and of the workers."""
+
+    def setup(self):
+        """Extend the parser configuration in order to expose this command."""
+        parser = self._parser.add_parser(
+            "show", help="Show a snapshot of the queue and of the workers.")
+        self._add_redis_arguments(parser)
+        parser.add_argument(
+            "--json", action="store_true", default=False,
+            help="Print the statistics as JSON."
+        )
+        parser.set_defaults(work=self.run)
+
+    def _work(self):
+        """Print the current statistics."""
+        stats = self._queue().stats()
+        if self.args.json:
+            print(json.dumps(stats, indent=2, sort_keys=True))
+        else:
+            print(self._render(stats))
+        return True
+
+
+class _Top(_StatsCommand):
+    """Refresh the statistics periodically."""
+
+    def setup(self):
+        """Extend the parser configuration in order to expose this command."""
+        parser = self._parser.add_parser(
+            "top", help="Refresh the statistics of the queue and of the "
+                        "workers periodically.")
+        self._add_redis_arguments(parser)
+        parser.add_argument(
+            "--interval", type=float, default=2,
+            help="How many seconds to wait between refreshes. Default: 2"
+        )
+        parser.set_defaults(work=self.run)
+
+    def _work(self):
+        """Print the statistics until interrupted."""
+        tasks_queue = self._queue()
+        previous = {}
+        try:
+            while True:
+                stats = tasks_queue.stats()
+                now = time.time()
+                rates = {}
+                for worker, values in stats["workers"].items():
+                    processed = int(values.get("processed", 0))
+                    if worker in previous:
+                        count, timestamp = previous[worker]
+                        rates[worker] = (processed - count) / (now - timestamp)
+                    previous[worker] = (processed, now)
+
+                print("\033[H\033[2J", end="")
+                print(time.strftime("%Y-%m-%d %H:%M:%S"))
+                print(self._render(stats, rates))
+                time.sleep(self.args.interval)
+        except KeyboardInterrupt:
+            pass
+        return True
+
+
+class Stats(cli.Group):
+    """Group for all the available statistics actions."""
+
+    commands = [(_Show, "actions"), (_Top, "actions")]
+
+    def setup(self):
+        """Extend the parser configuration in order to expose this command."""
+        parser = self._parser.add_parser(
+            "stats",
+            help="Statistics about the queue and the "
+                 "web workers (show/top).")
+
+        actions = parser.add_subparsers()
+        self._register_parser("actions", actions)
@@ -6,9 +6,8 @@ from tempfile import gettempdir
 import multiprocessing
 
 from demo_proxy import cli
+from demo_proxy.common import codec
 from demo_proxy.common import exception
-from demo_proxy.common import queue as demo_proxy_queue
-from demo_proxy import wsd
 
 PID_FILE = os.path.join(gettempdir(), "demo-proxy-worker.pid")
 
@@ -47,21 +46,195 @@ class _Start(cli.Command):
             default=int(os.environ.get("PROXY_REDIS_DATABASE", 0)),
             help="The Redis database that should be used. Default: 0"
         )
+        parser.add_argument(
+            "--compression", type=str,
+            choices=sorted(codec.ALGORITHMS),
+            default=os.environ.get("PROXY_COMPRESSION"),
+            help="The algorithm used for compressing the large payloads "
+                 "stored in Redis. Default: no compression"
+        )
+        parser.add_argument(
+            "--compression-threshold", type=int,
+            default=int(os.environ.get("PROXY_COMPRESSION_THRESHOLD", 1024)),
+            help="The minimum size (in bytes) of a compressed payload. "
+                 "Default: 1024"
+        )
+        parser.add_argument(
+            "--upstream", type=str, action="append", dest="upstreams",
+            help="The address of an upstream server. Can be used multiple "
+                 "times. Default: https://example.com"
+        )
+        parser.add_argument(
+            "--upstream-timeout", type=float,
+            default=float(os.environ.get("PROXY_UPSTREAM_TIMEOUT", 5)),
+            help="How many seconds to wait for an upstream response. "
+                 "Default: 5"
+        )
+        parser.add_argument(
+            "--max-concurrent", type=int,
+            default=int(os.environ.get("PROXY_MAX_CONCURRENT", 0)),
+            help="The maximum number of concurrent requests sent to the "
+                 "same upstream. Default: the number of workers"
+        )
+        parser.add_argument(
+            "--concurrency-timeout", type=float,
+            default=float(os.environ.get("PROXY_CONCURRENCY_TIMEOUT", 1)),
+            help="How many seconds a request waits for a free slot of a "
+                 "busy upstream before being rejected with 503. Default: 1"
+        )
+        parser.add_argument(
+            "--failure-threshold", type=int,
+            default=int(os.environ.get("PROXY_FAILURE_THRESHOLD", 5)),
+            help="The number of consecutive failures that opens the "
+                 "circuit of an upstream. Default: 5"
+        )
+        parser.add_argument(
+            "--recovery-timeout", type=float,
+            default=float(os.environ.get("PROXY_RECOVERY_TIMEOUT", 30)),
+            help="How many seconds an open circuit rejects requests "
+                 "before probing the upstream again. Default: 30"
+        )
+        parser.add_argument(
+            "--tenant-weight", type=str, action="append",
+            dest="tenant_weights",
+            default=[item for item in os.environ.get(
+                "PROXY_TENANT_WEIGHTS", "").split(",") if item],
+            help="The share of the workers received by a tenant, in the "
+                 "<tenant>=<weight> format (a positive weight). Can be used "
+                 "multiple times. Default weight: 1"
+        )
+        parser.add_argument(
+            "--batch-size", type=int,
+            default=int(os.environ.get("PROXY_BATCH_SIZE", 64)),
+            help="The maximum number of responses written to Redis "
+                 "in a single round trip. Default: 64"
+        )
+        parser.add_argument(
+            "--batch-delay", type=float,
+            default=float(os.environ.get("PROXY_BATCH_DELAY", 0.0005)),
+            help="The maximum time (in seconds) a response waits for "
+                 "other responses before being written. Default: 0.0005"
+        )
+        parser.add_argument(
+            "--hedge-percentile", type=float,
+            default=float(os.environ.get("PROXY_HEDGE_PERCENTILE", 0)),
+            help="Send a second attempt (to another upstream) for the GET "
+                 "and HEAD requests slower than this percentile of the "
+                 "recent latencies. Default: 0 (disabled)"
+        )
+        parser.add_argument(
+            "--hedge-budget", type=float,
+            default=float(os.environ.get("PROXY_HEDGE_BUDGET", 0.05)),
+            help="The maximum fraction of the requests that can be "
+                 "hedged. Default: 0.05"
+        )
+        parser.add_argument(
+            "--spill-threshold", type=int,
+            default=int(os.environ.get("PROXY_SPILL_THRESHOLD", 1048576)),
+            help="The upstream bodies larger than this (in bytes) are "
+                 "written to temporary files. Default: 1048576"
+        )
+        parser.add_argument(
+            "--memory-budget", type=int,
+            default=int(os.environ.get("PROXY_MEMORY_BUDGET", 67108864)),
+            help="The maximum number of bytes of upstream bodies kept in "
+                 "memory by the process, including the copies made while "
+                 "the responses are serialized for Redis (only the direct "
+                 "channel of the server, --reply-host, sends the bodies "
+                 "without copying them). A body which doesn't fit is "
+                 "answered with 502. Default: 67108864"
+        )
+        parser.add_argument(
+            "--drain-timeout", type=float,
+            default=float(os.environ.get("PROXY_DRAIN_TIMEOUT", 30)),
+            help="How many seconds the requests in progress have to finish "
+                 "when the worker is stopped. Default: 30"
+        )
+        parser.add_argument(
+            "--dns-ttl", type=float,
+            default=float(os.environ.get("PROXY_DNS_TTL", 30)),
+            help="For how many seconds the resolved upstream addresses "
+                 "are cached. Default: 30 (0 disables the cache)"
+        )
+        parser.add_argument(
+            "--warm-connections", type=int,
+            default=int(os.environ.get("PROXY_WARM_CONNECTIONS", 2)),
+            help="How many connections are opened to every upstream "
+                 "before taking tasks. Default: 2"
+        )
+        parser.add_argument(
+            "--upstream-retries", type=int,
+            default=int(os.environ.get("PROXY_UPSTREAM_RETRIES", 2)),
+            help="How many times a failed upstream call is retried (only "
+                 "for the idempotent methods or the connection failures). "
+                 "Default: 2"
+        )
+        parser.add_argument(
+            "--retry-budget", type=float,
+            default=float(os.environ.get("PROXY_RETRY_BUDGET", 0.1)),
+            help="The maximum fraction of the upstream calls that can be "
+                 "retried. Default: 0.1"
+        )
         parser.set_defaults(work=self.run)
 
+    @staticmethod
+    def _parse_weights(values):
+        """Parse the <tenant>=<weight> items received."""
+        weights = {}
+        for value in values:
+            tenant, _, weight = value.partition("=")
+            try:
+                weight = float(weight)
+            except ValueError:
+                weight = 0
+            # NaN and infinite weights are rejected as well
+            if not 0 < weight < float("inf"):
+                raise exception.DemoProxyException(
+                    "Invalid tenant weight: %(value)r", value=value)
+            weights[tenant.strip()] = weight
+        return weights
+
     def _work(self):
         """Start the demo_proxy web worker."""
+        # The heavy subsystems (gunicorn, requests, redis) are loaded only
+        # when they are actually required.
+        # pylint: disable=import-outside-toplevel
+        from demo_proxy.common import queue as demo_proxy_queue
+        from demo_proxy import wsd
+
         pid = os.getpid()
         with open(PID_FILE, "w") as file_handle:
             file_handle.write(str(pid))
 
+        payload_codec = codec.Codec(self.args.compression,
+                                    self.args.compression_threshold,
+                                    component="worker")
         queue = demo_proxy_queue.RedisQueue(self.args.redis_host,
                                             self.args.redis_port,
-                                            self.args.redis_database)
+                                            self.args.redis_database,
+                                            payload_codec)
         web_worker = wsd.ProxyWorker(
             tasks_queue=queue,
             workers_count=self.args.workers,
-            delay=0.1)
+            delay=0.1,
+            upstreams=self.args.upstreams,
+            upstream_timeout=(3.05, self.args.upstream_timeout),
+            max_concurrent=self.args.max_concurrent,
+            concurrency_timeout=self.args.concurrency_timeout,
+            failure_threshold=self.args.failure_threshold,
+            recovery_timeout=self.args.recovery_timeout,
+            tenant_weights=self._parse_weights(self.args.tenant_weights),
+            batch_size=self.args.batch_size,
+            batch_delay=self.args.batch_delay,
+            hedge_percentile=self.args.hedge_percentile,
+            hedge_budget=self.args.hedge_budget,
+            spill_threshold=self.args.spill_threshold,
+            memory_budget=self.args.memory_budget,
+            drain_timeout=self.args.drain_timeout,
+            dns_ttl=self.args.dns_ttl,
+            warm_connections=self.args.warm_connections,
+            upstream_retries=self.args.upstream_retries,
+            retry_budget=self.args.retry_budget)
         web_worker.run()
 
 
@@ -75,7 +248,11 @@ class _Stop(cli.Command):
         parser.set_defaults(work=self.run)
 
     def _work(self):
-        """Stop the demo_proxy web worker."""
+        """Stop the demo_proxy web worker.
+
+        The worker finishes the requests in progress and hands back
+        the ones not started yet.
+        """
         pid = None
         try:
             with open(PID_FILE, "r") as file_handle:
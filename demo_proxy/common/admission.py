@@ -0,0 +1,71 @@
+"""Admission control for the requests received by the front-end."""
+
+import math
+import random
+import threading
+import time
+
+
+class AdmissionControl(object):
+
+    """Decide if a new request should be queued or rejected right away.
+
+    Two signals are used:
+        * the depth of the remote queue, compared with `max_depth`
+          (only the requests served before the new one are counted);
+        * the time spent by requests in the queue. As in CoDel, the
+          queue is considered overloaded when the queue wait stays
+          above `target` for a whole `interval`. While overloaded,
+          requests are admitted with a probability of
+          1/sqrt(count + 1), where count is the number of consecutive
+          overloaded intervals, so the wait keeps being measured and
+          the load is shed harder the longer the overload lasts.
+    """
+
+    def __init__(self, max_depth=1000, target=0.5, interval=1.0):
+        self._max_depth = max_depth
+        self._target = target
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._first_above = 0
+        self._next_interval = 0
+        self._count = 0
+
+    @property
+    def retry_after(self):
+        """How many seconds a rejected client should wait."""
+        return int(math.ceil(self._interval))
+
+    @property
+    def overloaded(self):
+        """Whether the queue wait stays above the target."""
+        return self._count > 0
+
+    def observe(self, queue_wait):
+        """Record the time spent in queue by a request."""
+        now = time.time()
+        with self._lock:
+            if queue_wait < self._target:
+                self._first_above = 0
+                self._count = 0
+            elif not self._first_above:
+                self._first_above = now + self._interval
+            elif now >= self._first_above and now >= self._next_interval:
+                self._count += 1
+                self._next_interval = now + self._interval
+
+    def admit(self, depth):
+        """Check if a new request can be queued.
+
+        :returns: a tuple (admitted, reason), where reason is one of
+                  `depth` or `latency` for the rejected requests.
+        """
+        if depth >= self._max_depth:
+            return False, "depth"
+
+        with self._lock:
+            count = self._count
+        if count and random.random() >= 1 / math.sqrt(count + 1):
+            return False, "latency"
+
+        return True, None
@@ -0,0 +1,193 @@
+"""Per-upstream circuit breakers and concurrency limits."""
+
+import threading
+import time
+
+from demo_proxy.common import exception
+
+
+class CircuitBreaker(object):
+
+    """Stop sending requests to an upstream that keeps failing.
+
+    The breaker starts `closed` and lets every request pass. After
+    `failure_threshold` consecutive failures it becomes `open` and
+    rejects everything for `recovery_timeout` seconds. Then it moves
+    to `half-open` and lets at most `half_open_max` probes through:
+    a successful probe closes the circuit, a failed one opens it again.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30,
+                 half_open_max=1):
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+        self._half_open_max = half_open_max
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probes = 0
+
+    def _update(self):
+        """Move from `open` to `half-open` once the timeout expired."""
+        elapsed = time.time() - self._opened_at
+        if self._state == self.OPEN and elapsed >= self._recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+
+    @property
+    def state(self):
+        """The current state of the circuit."""
+        with self._lock:
+            self._update()
+            return self._state
+
+    def allow(self):
+        """Check if a new request can be sent to the upstream."""
+        with self._lock:
+            self._update()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN:
+                if self._probes < self._half_open_max:
+                    self._probes += 1
+                    return True
+            return False
+
+    def record_success(self):
+        """The upstream answered properly."""
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_failure(self):
+        """The upstream failed to answer."""
+        with self._lock:
+            self._failures += 1
+            tripped = self._failures >= self._failure_threshold
+            if tripped or self._state == self.HALF_OPEN:
+                self._state = self.OPEN
+                self._opened_at = time.time()
+                self._probes = 0
+
+
+class Upstream(object):
+
+    """Guard the access to a single upstream.
+
+    Combines a circuit breaker with a limit for the number of requests
+    sent concurrently to the same upstream. When the limit is reached,
+    a new request waits up to `acquire_timeout` seconds for a slot.
+    """
+
+    def __init__(self, url, max_concurrent=10, failure_threshold=5,
+                 recovery_timeout=30, acquire_timeout=1.0):
+        self._url = url
+        self._max_concurrent = max_concurrent
+        self._acquire_timeout = acquire_timeout
+        self._in_flight = 0
+        self._slots = threading.Condition()
+        self._breaker = CircuitBreaker(failure_threshold, recovery_timeout)
+
+    @property
+    def url(self):
+        """The address of the upstream."""
+        return self._url
+
+    @property
+    def max_concurrent(self):
+        """The maximum number of requests sent concurrently."""
+        return self._max_concurrent
+
+    @property
+    def breaker(self):
+        """The circuit breaker used for the current upstream."""
+        return self._breaker
+
+    def _take_slot(self):
+        """Wait (up to the acquire timeout) for a free slot."""
+        deadline = time.time() + self._acquire_timeout
+        with self._slots:
+            while self._in_flight >= self._max_concurrent:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._slots.wait(remaining)
+            self._in_flight += 1
+            return True
+
+    def _free_slot(self):
+        """Give back a slot to the requests waiting for it."""
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify()
+
+    def acquire(self):
+        """Reserve a slot for a new request.
+
+        :raises: :class:`exception.CircuitOpen` when the upstream is
+                 considered unhealthy and
+                 :class:`exception.ConcurrencyLimitExceeded` when
+                 there are too many requests in progress.
+        """
+        if self._breaker.state == CircuitBreaker.OPEN:
+            raise exception.CircuitOpen(upstream=self._url)
+        if not self._take_slot():
+            raise exception.ConcurrencyLimitExceeded(upstream=self._url)
+        if not self._breaker.allow():
+            self._free_slot()
+            raise exception.CircuitOpen(upstream=self._url)
+
+    def release(self, success):
+        """Free the slot and record the outcome of the request."""
+        self._free_slot()
+        if success:
+            self._breaker.record_success()
+        else:
+            self._breaker.record_failure()
+
+
+class UpstreamPool(object):
+
+    """Round robin over a set of guarded upstreams."""
+
+    def __init__(self, urls, **upstream_options):
+        self._upstreams = [Upstream(url, **upstream_options)
+                           for url in urls]
+        self._lock = threading.Lock()
+        self._index = 0
+
+    def __iter__(self):
+        return iter(self._upstreams)
+
+    def __len__(self):
+        return len(self._upstreams)
+
+    def choose(self, exclude=None):
+        """Return the next upstream with a closed circuit (if any).
+
+        When all the circuits are open, the next upstream in order is
+        returned in order to let it fail fast.
+
+        :param exclude: an upstream which should not be chosen (unless
+                        it is the only one available)
+        """
+        with self._lock:
+            start = self._index
+            self._index = (self._index + 1) % len(self._upstreams)
+
+        candidates = [self._upstreams[(start + step) % len(self._upstreams)]
+                      for step in range(len(self._upstreams))]
+        candidates = [upstream for upstream in candidates
+                      if upstream is not exclude] or candidates
+        for upstream in candidates:
+            if upstream.breaker.state != CircuitBreaker.OPEN:
+                return upstream
+        return candidates[0]
@@ -0,0 +1,36 @@
+"""Token budgets for the extra calls (retries, hedges)."""
+
+import threading
+
+
+class TokenBudget(object):
+
+    """Cap the extra load generated by the retried or hedged calls.
+
+    Every call earns `ratio` tokens (up to `capacity`) and every extra
+    call costs one token, so in the long run at most `ratio` of the
+    calls get an extra one, even when everything fails (no retry
+    storms).
+
+    :param full: whether the budget starts with all its tokens (so the
+                 first failures can be retried right away)
+    """
+
+    def __init__(self, ratio, capacity=10, full=False):
+        self._ratio = ratio
+        self._capacity = capacity
+        self._tokens = float(capacity if full else 0)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """A new call was made."""
+        with self._lock:
+            self._tokens = min(self._capacity, self._tokens + self._ratio)
+
+    def spend(self):
+        """Check if a new extra call is allowed."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
@@ -0,0 +1,104 @@
+"""Capture of the incoming requests, for replaying them later.
+
+Every server process appends the requests it receives to its own log
+file (`capture-<pid>.log`), which is rotated once it grows over the
+configured size. Each record starts with the arrival timestamp (a
+double) and the length of the data (4 bytes), in network order,
+followed by the zlib compressed JSON list `[lane, tenant, request]`.
+"""
+
+import heapq
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.StreamHandler())
+
+_HEADER = struct.Struct("!dI")
+
+
+class CaptureLog(object):
+
+    """Append the requests to a rotated log file, one per process.
+
+    :param max_bytes: the size which triggers the rotation of the log
+    :param backups:   how many rotated logs are kept
+    """
+
+    def __init__(self, directory, max_bytes=67108864, backups=5):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    @property
+    def path(self):
+        """The log file of the current process."""
+        return os.path.join(self._directory, "capture-%d.log" % os.getpid())
+
+    def _rotate(self):
+        """Keep the current log as a backup and start a new one."""
+        self._file.close()
+        self._file = None
+        for index in range(self._backups - 1, 0, -1):
+            source = "%s.%d" % (self.path, index)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d" % (self.path, index + 1))
+        if self._backups:
+            os.rename(self.path, "%s.1" % self.path)
+        else:
+            os.remove(self.path)
+
+    def record(self, timestamp, lane, tenant, request):
+        """Append the request (serialized as JSON) to the log."""
+        data = zlib.compress(json.dumps([lane, tenant, request]).encode())
+        with self._lock:
+            try:
+                if self._pid != os.getpid():
+                    # The server processes don't share the log file
+                    self._file = None
+                    self._pid = os.getpid()
+                if self._file is None:
+                    self._file = open(self.path, "ab")
+                self._file.write(_HEADER.pack(timestamp, len(data)))
+                self._file.write(data)
+                self._file.flush()
+                if self._file.tell() >= self._max_bytes:
+                    self._rotate()
+            except (IOError, OSError) as exc:
+                LOG.error("Failed to capture the request: %s", exc)
+                self._file = None
+
+    def close(self):
+        """Close the log of the current process."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_log(path):
+    """Get the (timestamp, lane, tenant, request) records from a log."""
+    with open(path, "rb") as file_handle:
+        while True:
+            header = file_handle.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            timestamp, size = _HEADER.unpack(header)
+            data = file_handle.read(size)
+            if len(data) < size:
+                LOG.warning("Truncated record at the end of %s", path)
+                return
+            lane, tenant, request = json.loads(zlib.decompress(data).decode())
+            yield timestamp, lane, tenant, request
+
+
+def read_logs(paths):
+    """Get the records of all the received logs, by arrival time."""
+    return heapq.merge(*[read_log(path) for path in paths])
@@ -0,0 +1,239 @@
+"""Return channels between the workers and the server processes.
+
+Every server process has a single mailbox where all its responses are
+delivered, no matter how many requests are in progress. The responses
+arrive either from the reply queue of the process (a Redis list read
+by a single listener) or directly from the workers.
+
+For the direct channel, the worker sends the response straight to the
+server process that is waiting for it. Every message starts
+with the length of the key (2 bytes), the length of the payload
+(4 bytes) and the length of the body (4 bytes), in network order,
+followed by the key, the payload and the body. The body is optional
+and is sent straight from its buffer, without being copied into the
+payload. Each message is acknowledged by the receiver with a single
+byte. The messages larger than the limit of the receiver are refused
+(the connection is closed), so the worker falls back to the remote
+queue.
+"""
+
+import logging
+import socket
+import struct
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.StreamHandler())
+
+_HEADER = struct.Struct("!HII")
+_ACK = b"\x01"
+# The keys are the UUIDs of the requests
+MAX_KEY_SIZE = 64
+
+
+def _read_exactly(connection, size):
+    """Read `size` bytes from the connection (None on EOF)."""
+    chunks = []
+    while size:
+        chunk = connection.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+class Mailbox(object):
+
+    """Hand the received responses to the requests waiting for them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def register(self, key):
+        """Start waiting for the response with the received key."""
+        with self._lock:
+            self._slots[key] = [threading.Event(), None, None]
+
+    def unregister(self, key):
+        """Stop waiting for the response with the received key."""
+        with self._lock:
+            self._slots.pop(key, None)
+
+    def deliver(self, key, payload, body=None):
+        """Hand the payload to the waiting request (if any)."""
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                return False
+            slot[1] = payload
+            slot[2] = body
+        slot[0].set()
+        return True
+
+    def wait(self, key, timeout):
+        """Wait for the response with the received key.
+
+        :returns: the payload and the body sent separately (if any) or
+                  None if the response is not available yet.
+        """
+        with self._lock:
+            slot = self._slots.get(key)
+        if slot is None or not slot[0].wait(timeout):
+            return None
+        return slot[1], slot[2]
+
+
+class QueueListener(object):
+
+    """Receive all the responses added in the reply queue of the process.
+
+    A single thread (and a single Redis connection) is used no matter
+    how many requests are waiting for their response.
+    """
+
+    def __init__(self, tasks_queue, mailbox, name):
+        self._queue = tasks_queue
+        self._mailbox = mailbox
+        self._name = name
+
+        thread = threading.Thread(target=self._listen, name="queue-listener")
+        thread.setDaemon(True)
+        thread.start()
+
+    @property
+    def name(self):
+        """The name of the reply queue."""
+        return self._name
+
+    def _listen(self):
+        """Hand the responses to the waiting requests."""
+        while True:
+            try:
+                responses = self._queue.get_responses(self._name)
+            except Exception as exc:    # pylint: disable=broad-except
+                LOG.error("Failed to read the reply queue: %s", exc)
+                time.sleep(1)
+                continue
+
+            for key, payload in responses:
+                self._mailbox.deliver(key, payload)
+
+
+class ReplyListener(object):
+
+    """Receive the responses sent directly by the workers.
+
+    :param advertise:   the host name the workers should connect to
+    :param bind:        the address the listener is bound to (by
+                        default, the advertised one)
+    :param max_size:    the size of the largest message accepted
+    """
+
+    def __init__(self, advertise, mailbox, bind=None, port=0,
+                 max_size=67108864):
+        self._mailbox = mailbox
+        self._max_size = max_size
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((bind or advertise, port))
+        self._socket.listen(128)
+        self._address = "%s:%d" % (advertise, self._socket.getsockname()[1])
+
+        thread = threading.Thread(target=self._accept, name="reply-listener")
+        thread.setDaemon(True)
+        thread.start()
+
+    @property
+    def address(self):
+        """The address the workers should send the responses to."""
+        return self._address
+
+    def _accept(self):
+        """Accept the connections from the workers."""
+        while True:
+            connection, _ = self._socket.accept()
+            thread = threading.Thread(target=self._serve, args=(connection,),
+                                      name="reply-connection")
+            thread.setDaemon(True)
+            thread.start()
+
+    def _serve(self, connection):
+        """Read the responses sent over the received connection."""
+        try:
+            while True:
+                header = _read_exactly(connection, _HEADER.size)
+                if header is None:
+                    break
+                key_size, payload_size, body_size = _HEADER.unpack(header)
+                size = key_size + payload_size + body_size
+                if key_size > MAX_KEY_SIZE or size > self._max_size:
+                    LOG.warning("Refused a reply of %d bytes (key: %d "
+                                "bytes)", size, key_size)
+                    break
+                message = _read_exactly(connection, size)
+                if message is None:
+                    break
+                payload_end = key_size + payload_size
+                self._mailbox.deliver(message[:key_size].decode(),
+                                      message[key_size:payload_end],
+                                      message[payload_end:] or None)
+                connection.sendall(_ACK)
+        except (socket.error, ValueError) as exc:
+            LOG.debug("Reply connection dropped: %s", exc)
+        finally:
+            connection.close()
+
+
+class ReplySender(object):
+
+    """Send the responses directly to the server processes.
+
+    The connections are kept open and reused for the next responses
+    sent to the same address.
+    """
+
+    def __init__(self, timeout=1.0):
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _connection(self, address):
+        """Get an idle connection or open a new one."""
+        with self._lock:
+            idle = self._idle.get(address)
+            if idle:
+                return idle.pop()
+
+        host, _, port = address.rpartition(":")
+        return socket.create_connection((host, int(port)), self._timeout)
+
+    def send(self, address, key, payload, body=None):
+        """Send the payload to the received address.
+
+        :param body: a buffer (e.g. a memoryview) sent after the payload
+                     without copying it
+        :returns: True if the payload was acknowledged by the receiver.
+        """
+        connection = None
+        body_size = len(body) if body is not None else 0
+        try:
+            connection = self._connection(address)
+            key = key.encode()
+            header = _HEADER.pack(len(key), len(payload), body_size)
+            connection.sendall(b"".join((header, key, payload)))
+            if body_size:
+                connection.sendall(body)
+            if _read_exactly(connection, len(_ACK)) != _ACK:
+                raise socket.error("Invalid acknowledgement.")
+        except (socket.error, ValueError) as exc:
+            LOG.debug("Failed to send the reply to %s: %s", address, exc)
+            if connection is not None:
+                connection.close()
+            return False
+
+        with self._lock:
+            self._idle.setdefault(address, []).append(connection)
+        return True
@@ -0,0 +1,90 @@
+"""Compression of the payloads stored in the remote queue."""
+
+import bz2
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:     # Python 2.7
+    lzma = None
+
+from demo_proxy.common import exception
+from demo_proxy.common import metrics
+
+# The serialized objects always start with `{`, so this marker can't
+# be mistaken for an uncompressed payload.
+MARKER = b"\x00"
+
+ALGORITHMS = {
+    "zlib": (b"z", zlib.compress, zlib.decompress),
+    "bz2": (b"b", bz2.compress, bz2.decompress),
+}
+if lzma is not None:
+    ALGORITHMS["lzma"] = (b"x", lambda data, level: lzma.compress(
+        data, preset=level), lzma.decompress)
+
+_DECOMPRESS = {flag: decompress
+               for flag, _, decompress in ALGORITHMS.values()}
+
+
+class Codec(object):
+
+    """Compress the payloads larger than `threshold` bytes.
+
+    A compressed payload starts with the marker and the flag of the
+    algorithm used, so the payloads are decoded transparently no matter
+    how the producer was configured.
+    """
+
+    def __init__(self, algorithm=None, threshold=1024, level=6,
+                 component="queue"):
+        if algorithm and algorithm not in ALGORITHMS:
+            raise exception.NotSupported(
+                feature="The %r compression" % algorithm,
+                context="this environment")
+
+        self._algorithm = algorithm
+        self._threshold = threshold
+        self._level = level
+        self._metrics = metrics.Metrics(component)
+
+    @property
+    def metrics(self):
+        """The compression ratio and the CPU time spent."""
+        return self._metrics
+
+    def encode(self, data):
+        """Compress the payload if it is large enough."""
+        if not isinstance(data, bytes):
+            data = data.encode()
+        if not self._algorithm or len(data) < self._threshold:
+            return data
+
+        flag, compress, _ = ALGORITHMS[self._algorithm]
+        start = time.time()
+        compressed = compress(data, self._level)
+        self._metrics.observe("compression.seconds", time.time() - start)
+        self._metrics.incr("compression.bytes_in", len(data))
+        if len(compressed) + 2 >= len(data):
+            self._metrics.incr("compression.bytes_out", len(data))
+            return data
+
+        self._metrics.incr("compression.bytes_out", len(compressed) + 2)
+        return MARKER + flag + compressed
+
+    def decode(self, data):
+        """Decompress the payload if it was compressed."""
+        if data is None or not data.startswith(MARKER):
+            return data
+
+        decompress = _DECOMPRESS.get(data[1:2])
+        if decompress is None:
+            raise exception.NotSupported(
+                feature="The compression flag %r" % data[1:2],
+                context="this environment")
+
+        start = time.time()
+        data = decompress(data[2:])
+        self._metrics.observe("decompression.seconds", time.time() - start)
+        return data
@@ -0,0 +1,54 @@
+"""In-process cache for the name resolution.
+
+The system resolver doesn't expose the TTL of the records, so the
+results are kept for a configured number of seconds. When a lookup
+fails, the expired result (if any) is used instead.
+"""
+
+import socket
+import threading
+import time
+
+_RESOLVER = socket.getaddrinfo
+
+
+class DNSCache(object):
+
+    """Thread-safe cache over :func:`socket.getaddrinfo`."""
+
+    def __init__(self, ttl=30, max_entries=1024, resolver=None):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._resolver = resolver or _RESOLVER
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        """Same as :func:`socket.getaddrinfo`, using the cached results."""
+        # pylint: disable=redefined-builtin,too-many-arguments
+        # pylint: disable=too-many-positional-arguments
+        key = (host, port, family, type, proto, flags)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            return list(entry[1])
+
+        try:
+            result = self._resolver(host, port, family, type, proto, flags)
+        except socket.gaierror:
+            if entry is None:
+                raise
+            return list(entry[1])
+
+        with self._lock:
+            if len(self._entries) >= self._max_entries:
+                self._entries.clear()
+            self._entries[key] = (time.time() + self._ttl, result)
+        return list(result)
+
+
+def install(ttl):
+    """Resolve all the names of the process through a shared cache."""
+    cache = DNSCache(ttl)
+    socket.getaddrinfo = cache.getaddrinfo
+    return cache
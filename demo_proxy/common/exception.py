@@ -50,3 +50,17 @@ class NotFound(DemoProxyException):
     """The required object is not available in container."""
 
     template = "The %(object)r was not found in %(container)s."
+
+
+class CircuitOpen(DemoProxyException):
+
+    """The upstream is considered unhealthy and requests are rejected."""
+
+    template = "The circuit for %(upstream)s is open."
+
+
+class ConcurrencyLimitExceeded(DemoProxyException):
+
+    """There are too many requests in progress for the upstream."""
+
+    template = "Too many concurrent requests for %(upstream)s."
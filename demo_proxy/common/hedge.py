@@ -0,0 +1,31 @@
+"""Helpers for hedging the slow upstream requests."""
+
+import collections
+import threading
+
+
+class LatencyTracker(object):
+
+    """Keep the most recent latencies and compute their percentiles."""
+
+    def __init__(self, window=512, min_samples=20):
+        self._samples = collections.deque(maxlen=window)
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        """Add a new latency sample (in seconds)."""
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, percent):
+        """Return the received percentile of the recent latencies.
+
+        :returns: None while there are not enough samples.
+        """
+        with self._lock:
+            if len(self._samples) < self._min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
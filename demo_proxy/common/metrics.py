@@ -0,0 +1,56 @@
+"""Lightweight counters exported through the remote queue."""
+
+import collections
+import threading
+import time
+
+
+class Metrics(object):
+
+    """Thread-safe counters periodically exported to the remote queue.
+
+    The values are accumulated locally and pushed as increments, so
+    any number of processes can report into the same component.
+    """
+
+    def __init__(self, component, interval=1.0):
+        self._component = component
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._values = collections.defaultdict(float)
+        self._last_flush = time.time()
+
+    @property
+    def component(self):
+        """The name used for grouping the exported values."""
+        return self._component
+
+    def incr(self, name, amount=1):
+        """Increment the received counter."""
+        with self._lock:
+            self._values[name] += amount
+
+    def observe(self, name, value):
+        """Record a new sample for the received measurement."""
+        with self._lock:
+            self._values[name + ".count"] += 1
+            self._values[name + ".sum"] += value
+
+    def snapshot(self, reset=False):
+        """Return the values gathered since the last reset."""
+        with self._lock:
+            values = dict(self._values)
+            if reset:
+                self._values.clear()
+        return values
+
+    def flush(self, tasks_queue, force=False):
+        """Export the gathered values if the flush interval expired."""
+        now = time.time()
+        if not force and now - self._last_flush < self._interval:
+            return
+        self._last_flush = now
+
+        values = self.snapshot(reset=True)
+        if values:
+            tasks_queue.add_metrics(self._component, values)
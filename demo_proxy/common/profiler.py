@@ -0,0 +1,199 @@
+"""Low overhead sampling profiler, toggled at runtime.
+
+The stacks of all the threads are sampled periodically and dumped in
+the collapsed format (one `role;frame;frame count` line per stack)
+used for the flame graphs. Every stack starts with the role of the
+thread, taken from its name (dispatcher, supervisor, worker, etc.).
+
+A running process starts profiling when it receives :data:`SIGNAL`.
+The duration is read from the control file of the component (written
+by the `demo_proxy profile` command) and the samples are written in
+:func:`output_file` when the profiling stops. Receiving the signal
+while profiling stops it earlier.
+"""
+
+import collections
+import glob
+import json
+import logging
+import os
+import re
+import signal
+import sys
+from tempfile import gettempdir
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.StreamHandler())
+
+SIGNAL = signal.SIGPROF
+DEFAULT_SECONDS = 30
+DEFAULT_INTERVAL = 0.01
+
+# The roles of the threads which are not named after their role
+ROLES = {
+    "MainThread": "dispatcher",
+    "ThreadPoolExecutor": "dispatcher",
+    "primary": "upstream",
+    "hedge": "upstream",
+}
+_SUFFIX = re.compile(r"[-_]?\d+(_\d+)?$")
+
+
+def control_file(component):
+    """The file where the profiling options of the component are kept."""
+    return os.path.join(gettempdir(), "demo-proxy-%s.profile" % component)
+
+
+def output_file(component, pid=None):
+    """The file where the samples of the received process are dumped."""
+    return os.path.join(gettempdir(), "demo-proxy-%s-%s.folded" %
+                        (component, pid or os.getpid()))
+
+
+def collect(component, since=0):
+    """Merge the samples dumped by the processes of the component.
+
+    :param since: ignore the files written before this timestamp
+    """
+    samples = collections.Counter()
+    for path in glob.glob(output_file(component, "*")):
+        try:
+            if os.path.getmtime(path) < since:
+                continue
+            with open(path, "r") as file_handle:
+                for line in file_handle:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    samples[stack] += int(count)
+        except (IOError, OSError, ValueError):
+            continue
+    return samples
+
+
+def thread_role(name):
+    """Get the role of a thread from its name."""
+    name = _SUFFIX.sub("", name or "") or "thread"
+    return ROLES.get(name, name)
+
+
+def _frame_name(frame):
+    """A short description of the function executed by the frame."""
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return "%s:%s:%d" % (module, code.co_name, code.co_firstlineno)
+
+
+class Profiler(object):
+
+    """Sample the stacks of all the threads from the current process."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._samples = collections.Counter()
+
+    @property
+    def running(self):
+        """Whether the profiler is sampling."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def _sample(self):
+        """Record the current stack of every thread."""
+        names = {thread.ident: thread.name
+                 for thread in threading.enumerate()}
+        own = threading.current_thread().ident
+        # pylint: disable=protected-access
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(thread_role(names.get(ident)))
+            self._samples[";".join(reversed(stack))] += 1
+
+    def _run(self, seconds, output):
+        """Sample the threads until the time is up or stop is called."""
+        deadline = time.time() + seconds
+        while time.time() < deadline and not self._stop_event.is_set():
+            self._sample()
+            self._stop_event.wait(self._interval)
+        self.dump(output)
+
+    def start(self, seconds, output):
+        """Sample the threads for `seconds` and dump them in `output`."""
+        with self._lock:
+            if self.running:
+                return False
+            self._samples.clear()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(seconds, output),
+                                            name="profiler")
+            self._thread.setDaemon(True)
+            self._thread.start()
+        LOG.info("Profiling for %ss, the samples go to %s", seconds, output)
+        return True
+
+    def stop(self):
+        """Stop the sampling (the samples are dumped)."""
+        self._stop_event.set()
+
+    def dump(self, output):
+        """Write the samples in the collapsed stack format."""
+        temporary = "%s.tmp" % output
+        with open(temporary, "w") as file_handle:
+            for stack, count in sorted(self._samples.items()):
+                file_handle.write("%s %d\n" % (stack, count))
+        os.rename(temporary, output)
+
+
+_PROFILER = Profiler()
+
+
+def toggle(component):
+    """Start profiling the process or stop it, if already running."""
+    if _PROFILER.running:
+        _PROFILER.stop()
+        return
+
+    options = {}
+    try:
+        with open(control_file(component), "r") as file_handle:
+            options = json.load(file_handle)
+    except (IOError, OSError, ValueError):
+        pass
+    _PROFILER.start(options.get("seconds", DEFAULT_SECONDS),
+                    output_file(component))
+
+
+def install(component):
+    """Toggle the profiler when the process receives :data:`SIGNAL`.
+
+    Must be called from the main thread.
+    """
+    def _handler(signum, frame):
+        # pylint: disable=unused-argument
+        toggle(component)
+
+    signal.signal(SIGNAL, _handler)
+
+
+def forward(pids):
+    """Forward :data:`SIGNAL` to the processes returned by `pids()`.
+
+    Must be called from the main thread.
+    """
+    def _handler(signum, frame):
+        # pylint: disable=unused-argument
+        for pid in pids():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    signal.signal(SIGNAL, _handler)
@@ -2,11 +2,102 @@
 # pylint: disable=inconsistent-return-statements
 
 import abc
+import logging
+import math
+import threading
+import time
 
 import six
+from six.moves import queue
 
+from demo_proxy.common import budget
+from demo_proxy.common import codec as demo_proxy_codec
+from demo_proxy.common import retry
 from demo_proxy.common import utils
 
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.StreamHandler())
+
+# The priority lanes, from the most important one to the least one
+LANES = ("high", "normal", "low")
+DEFAULT_LANE = "normal"
+DEFAULT_TENANT = "default"
+# For how long the responses of a dead server process are kept
+RESPONSES_TTL = 60
+# For how long a worker is listed after its last heartbeat
+HEARTBEAT_TTL = 10
+# The sets listing the reply queues, the components exporting metrics
+# and the workers (so the statistics don't scan the whole keyspace)
+REPLY_QUEUES = "reply_queues"
+COMPONENTS = "components"
+WORKERS = "workers"
+# For how long the claim of an idempotency key outlives the server's
+# timeout (in case the server process is gone before releasing it)
+PENDING_SLACK = 5
+
+# Pop an item from the tenant's list and forget the tenant when the
+# list is empty (atomically, so a concurrent push cannot be lost).
+_POP_REQUEST = """
+local item = redis.call('rpop', KEYS[1])
+if not item then
+    redis.call('srem', KEYS[2], ARGV[1])
+end
+return item
+"""
+
+# Refill the token bucket stored at KEYS[1] and take up to ARGV[3]
+# tokens from it. Returns the number of tokens granted and, when
+# nothing was granted, the number of seconds until a token is ready.
+_TAKE_TOKENS = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('time')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens),
+           'updated', tostring(now))
+redis.call('expire', KEYS[1], math.ceil(burst / rate) + 1)
+local wait = 0
+if granted == 0 then
+    wait = (1 - tokens) / rate
+end
+return {granted, tostring(wait)}
+"""
+
+# Claim the idempotency key KEYS[1] for the request ARGV[1] (which
+# keeps the TTL of the memo, ARGV[2]). Returns the current value
+# when the key was already claimed.
+_CLAIM = """
+local value = 'pending:' .. ARGV[1] .. ':' .. ARGV[2]
+if redis.call('set', KEYS[1], value, 'NX', 'EX', ARGV[3]) then
+    return false
+end
+return redis.call('get', KEYS[1])
+"""
+
+# Replace the claim of the request ARGV[1] with the memo ARGV[2] (or
+# release it, when the memo is empty).
+_SETTLE = """
+local owner = 'pending:' .. ARGV[1] .. ':'
+local value = redis.call('get', KEYS[1])
+if not value or string.sub(value, 1, #owner) ~= owner then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('del', KEYS[1])
+else
+    local ttl = tonumber(string.sub(value, #owner + 1))
+    redis.call('set', KEYS[1], 'done:' .. ARGV[2], 'EX', ttl)
+end
+return 1
+"""
+
 
 @six.add_metaclass(abc.ABCMeta)
 class _Queue(object):
@@ -27,13 +118,53 @@ class RedisQueue(_Queue):
 
     """Simple Redis queue."""
 
-    def __init__(self, host, port, database):
-        self._conn = utils.RedisConnection(host, port, database)
+    def __init__(self, host, port, database, codec=None):
+        self._codec = codec or demo_proxy_codec.Codec()
+        self._retry = retry.RetryPolicy(
+            utils.ATTEMPTS, utils.RETRY_INTERVAL,
+            budget=budget.TokenBudget(0.1, full=True),
+            metrics=self._codec.metrics,
+            name="redis")
+        self._conn = utils.RedisConnection(host, port, database, self._retry)
+        self._pop_request = None
+        self._take_tokens = None
+        self._claim = None
+        self._settle = None
 
-    def push(self, request):
-        """Add request to the processing queue."""
-        conn = self._conn.rcon
-        conn.lpush("request", request.to_json())
+    @property
+    def retry_policy(self):
+        """The retry policy used for the Redis calls."""
+        return self._retry
+
+    @staticmethod
+    def _lane_key(lane, tenant=None):
+        """The key of the tenant's list or of the lane's tenants set."""
+        if tenant is None:
+            return "request:%s:tenants" % lane
+        return "request:%s:%s" % (lane, tenant)
+
+    def push(self, request, lane=DEFAULT_LANE, tenant=DEFAULT_TENANT):
+        """Add request to the processing queue of the received tenant."""
+        pipe = self._conn.rcon.pipeline()
+        pipe.lpush(self._lane_key(lane, tenant),
+                   self._codec.encode(request.to_json()))
+        pipe.sadd(self._lane_key(lane), tenant)
+        pipe.execute()
+        self._codec.metrics.flush(self)
+
+    def requeue(self, tasks):
+        """Hand back the (lane, tenant, request) tasks not processed.
+
+        The tasks are added at the end the workers read from, so they
+        keep their place in line.
+        """
+        pipe = self._conn.rcon.pipeline()
+        for lane, tenant, request in reversed(tasks):
+            pipe.rpush(self._lane_key(lane, tenant),
+                       self._codec.encode(request.to_json()))
+            pipe.sadd(self._lane_key(lane), tenant)
+        pipe.execute()
+        self._codec.metrics.flush(self)
 
     def pop(self, request):
         """Get response if available."""
@@ -41,14 +172,335 @@ class RedisQueue(_Queue):
         if conn.hexists("response", request.uuid):
             response = conn.hget("response", request.uuid)
             conn.hdel("response", request.uuid)
-            return response
+            return self._codec.decode(response)
 
-    def get_request(self):
-        """Get the first item in queue to be processed."""
+    def tenants(self, lane):
+        """Get the tenants with requests waiting in the received lane."""
         conn = self._conn.rcon
-        return conn.rpop("request")
+        return sorted(tenant.decode()
+                      for tenant in conn.smembers(self._lane_key(lane)))
+
+    def get_request(self, lane=DEFAULT_LANE, tenant=DEFAULT_TENANT):
+        """Get the first request of the tenant to be processed."""
+        conn = self._conn.rcon
+        if self._pop_request is None:
+            self._pop_request = conn.register_script(_POP_REQUEST)
+        return self._codec.decode(self._pop_request(
+            keys=[self._lane_key(lane, tenant), self._lane_key(lane)],
+            args=[tenant], client=conn))
+
+    def _add_response(self, pipe, request, response):
+        """Queue the commands which store the response for the request.
+
+        When the request was sent by a server process with its own
+        reply queue, the response is added to that queue.
+        """
+        payload = self._codec.encode(response.to_json())
+        if not request.reply_queue:
+            pipe.hset("response", request.uuid, payload)
+            return
+
+        key = "response:%s" % request.reply_queue
+        pipe.lpush(key, request.uuid.encode() + b":" + payload)
+        pipe.expire(key, RESPONSES_TTL)
+        pipe.sadd(REPLY_QUEUES, request.reply_queue)
 
     def set_response(self, request, response):
         """Add the response for the received request."""
+        self.set_responses([(request, response)])
+
+    def set_responses(self, responses):
+        """Add all the received (request, response) pairs at once."""
+        pipe = self._conn.rcon.pipeline(transaction=False)
+        for request, response in responses:
+            self._add_response(pipe, request, response)
+        pipe.execute()
+        self._codec.metrics.flush(self)
+
+    def get_responses(self, reply_queue, timeout=1):
+        """Wait for the responses added in the received reply queue.
+
+        :returns: a list of (uuid, response) tuples.
+        """
+        key = "response:%s" % reply_queue
+        conn = self._conn.rcon
+        item = conn.brpop(key, timeout)
+        if not item:
+            return []
+
+        pipe = conn.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        items = [item[1]] + pipe.execute()[0]
+        responses = []
+        for item in items:
+            uuid, _, response = item.partition(b":")
+            responses.append((uuid.decode(), self._codec.decode(response)))
+        self._codec.metrics.flush(self)
+        return responses
+
+    def claim(self, key, owner, ttl, timeout):
+        """Claim the idempotency key for the received request.
+
+        :param ttl:     for how long the response is remembered
+        :param timeout: for how long the server waits for the response
+        :returns: None if the key was claimed, ("pending", None) when
+                  another request is in progress and ("done", payload)
+                  when the response is already known.
+        """
+        conn = self._conn.rcon
+        if self._claim is None:
+            self._claim = conn.register_script(_CLAIM)
+        value = self._claim(keys=["idempotency:%s" % key],
+                            args=[owner, ttl,
+                                  int(math.ceil(timeout)) + PENDING_SLACK],
+                            client=conn)
+        return self._idempotency_state(value)
+
+    def memo(self, key):
+        """Get the state of the idempotency key (see :meth:`claim`)."""
+        value = self._conn.rcon.get("idempotency:%s" % key)
+        return self._idempotency_state(value)
+
+    def _idempotency_state(self, value):
+        """Decode the value stored for an idempotency key."""
+        if value is None:
+            return None
+        state, _, payload = value.partition(b":")
+        if state == b"done":
+            return "done", self._codec.decode(payload)
+        return "pending", None
+
+    def settle(self, key, owner, response=None):
+        """Remember the response of the request owning the key.
+
+        Without a response, the key is released so the next request
+        with the same key is processed again.
+        """
+        conn = self._conn.rcon
+        if self._settle is None:
+            self._settle = conn.register_script(_SETTLE)
+        payload = b""
+        if response is not None:
+            payload = self._codec.encode(response.to_json())
+        self._settle(keys=["idempotency:%s" % key], args=[owner, payload],
+                     client=conn)
+
+    def take_tokens(self, key, rate, burst, count=1):
+        """Take up to `count` tokens from the received token bucket.
+
+        :returns: a tuple (granted, retry_after).
+        """
+        conn = self._conn.rcon
+        if self._take_tokens is None:
+            self._take_tokens = conn.register_script(_TAKE_TOKENS)
+        granted, retry_after = self._take_tokens(
+            keys=["ratelimit:%s" % key], args=[rate, burst, count],
+            client=conn)
+        return int(granted), float(retry_after)
+
+    def size(self):
+        """Get the number of requests waiting to be processed."""
+        return sum(self.depths().values())
+
+    def depths(self):
+        """Get the number of requests waiting in every lane."""
+        conn = self._conn.rcon
+        lanes = {lane: self.tenants(lane) for lane in LANES}
+        pipe = conn.pipeline(transaction=False)
+        for lane in LANES:
+            for tenant in lanes[lane]:
+                pipe.llen(self._lane_key(lane, tenant))
+        results = iter(pipe.execute())
+        return {lane: sum(next(results) for _ in lanes[lane])
+                for lane in LANES}
+
+    def add_metrics(self, component, values):
+        """Increment the metrics exported by the received component."""
+        pipe = self._conn.rcon.pipeline(transaction=False)
+        for name, value in values.items():
+            pipe.hincrbyfloat("metrics:%s" % component, name, value)
+        pipe.sadd(COMPONENTS, component)
+        pipe.execute()
+
+    def heartbeat(self, worker, values):
+        """Publish the state of the received worker.
+
+        The state is forgotten if the worker stops sending heartbeats.
+        """
+        key = "worker:%s" % worker
+        pipe = self._conn.rcon.pipeline(transaction=False)
+        pipe.hset(key, mapping=values)
+        pipe.expire(key, HEARTBEAT_TTL)
+        pipe.sadd(WORKERS, worker)
+        pipe.execute()
+
+    def stats(self):
+        """Get a snapshot of the queue, the responses and the workers.
+
+        :returns: a dictionary with the depth of every tenant's list
+                  (grouped by lane), the number of responses waiting
+                  to be read, the exported metrics and the state of
+                  the live workers.
+        """
         conn = self._conn.rcon
-        conn.hset("response", request.uuid, response.to_json())
+        lanes = {lane: self.tenants(lane) for lane in LANES}
+        pipe = conn.pipeline(transaction=False)
+        for key in (REPLY_QUEUES, COMPONENTS, WORKERS):
+            pipe.smembers(key)
+        reply_queues, components, workers = [
+            sorted(name.decode() for name in names)
+            for names in pipe.execute()]
+
+        pipe = conn.pipeline(transaction=False)
+        for lane in LANES:
+            for tenant in lanes[lane]:
+                pipe.llen(self._lane_key(lane, tenant))
+        pipe.hlen("response")
+        for name in reply_queues:
+            pipe.llen("response:%s" % name)
+        for name in components:
+            pipe.hgetall("metrics:%s" % name)
+        for name in workers:
+            pipe.hgetall("worker:%s" % name)
+        results = iter(pipe.execute())
+
+        def _decode(values):
+            return {name.decode(): value.decode()
+                    for name, value in values.items()}
+
+        stats = {
+            "lanes": {lane: {tenant: next(results)
+                             for tenant in lanes[lane]}
+                      for lane in LANES},
+            "responses": {
+                "pending": next(results),
+                "reply_queues": {name: next(results)
+                                 for name in reply_queues},
+            },
+            "metrics": {name: _decode(next(results))
+                        for name in components},
+            "workers": {name: _decode(next(results)) for name in workers},
+        }
+        self._forget_expired(stats)
+        return stats
+
+    def _forget_expired(self, stats):
+        """Remove the expired reply queues and workers from the stats.
+
+        They are removed from their sets as well.
+        """
+        pipe = self._conn.rcon.pipeline(transaction=False)
+        for key, items in ((REPLY_QUEUES, stats["responses"]["reply_queues"]),
+                           (WORKERS, stats["workers"])):
+            for name, value in list(items.items()):
+                if not value:
+                    del items[name]
+                    pipe.srem(key, name)
+        pipe.execute()
+
+
+class ResponseWriter(object):
+
+    """Gather the responses from all the threads and store them in batches.
+
+    The first response received opens a batch which is flushed when
+    it reaches `batch_size` responses or after `max_delay` seconds, so
+    the latency added to a response is bounded by `max_delay` plus the
+    time required for a pipelined write.
+
+    A batch which cannot be written is retried according to the retry
+    policy and then written one response at a time, so a single failed
+    response doesn't take the whole batch with it.
+    """
+
+    def __init__(self, tasks_queue, batch_size=64, max_delay=0.0005,
+                 retry_policy=None):
+        self._queue = tasks_queue
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._retry = retry_policy or retry.RetryPolicy(
+            utils.ATTEMPTS, utils.RETRY_INTERVAL, name="redis")
+        self._pending = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        """Start flushing the responses received."""
+        self._thread = threading.Thread(target=self._run,
+                                        name="response-writer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Flush the pending responses and stop the writer."""
+        self._pending.put(None)
+        if self._thread:
+            self._thread.join()
+
+    def submit(self, request, response, callback=None):
+        """Schedule the response for writing.
+
+        :param callback: called once the response was written (or the
+                         writer gave up on it)
+        """
+        self._pending.put((request, response, callback))
+
+    def _batch(self):
+        """Wait for the next batch of responses.
+
+        :returns: a tuple (batch, stopped).
+        """
+        item = self._pending.get()
+        if item is None:
+            return [], True
+
+        batch = [item]
+        deadline = time.time() + self._max_delay
+        while len(batch) < self._batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    item = self._pending.get(timeout=remaining)
+                else:
+                    item = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        """Flush the responses until the writer is stopped."""
+        stopped = False
+        while not stopped:
+            batch, stopped = self._batch()
+            if not batch:
+                continue
+            self._write([(request, response)
+                         for request, response, _ in batch])
+            for _, _, callback in batch:
+                if callback is not None:
+                    callback()
+
+    def _write(self, batch):
+        """Store the batch, retrying it and then each of its responses."""
+        self._retry.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._queue.set_responses(batch)
+                return
+            except Exception as exc:    # pylint: disable=broad-except
+                LOG.warning("Failed to store %d responses: %s",
+                            len(batch), exc)
+                if not self._retry.retry(attempt):
+                    break
+
+        for request, response in batch:
+            try:
+                self._queue.set_response(request, response)
+            except Exception as exc:    # pylint: disable=broad-except
+                LOG.error("Failed to store the response for %s: %s",
+                          request.uuid, exc)
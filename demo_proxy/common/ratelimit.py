@@ -0,0 +1,72 @@
+"""Token bucket rate limiting shared by all the front-end processes."""
+
+import threading
+import time
+
+
+class RateLimiter(object):
+
+    """Rate limiter backed by token buckets stored in the remote queue.
+
+    In order to avoid a round trip to Redis for each request, the
+    tokens are leased in batches and consumed locally. A client whose
+    bucket is empty is rejected locally until the bucket refills.
+
+    :param rate:        the number of tokens added to a bucket per second
+    :param burst:       the capacity of a bucket (at least one token,
+                        otherwise no request could ever be granted)
+    :param batch:       how many tokens are leased at once
+    :param lease_ttl:   for how long the leased tokens can be used
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, tasks_queue, prefix, rate, burst, batch=None,
+                 lease_ttl=1.0, max_keys=10000):
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-positional-arguments
+        self._queue = tasks_queue
+        self._prefix = prefix
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._batch = batch or max(1, int(self._burst // 10))
+        self._lease_ttl = lease_ttl
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        # key -> (tokens, lease expiry, denied until)
+        self._local = {}
+
+    def _prune(self, now):
+        """Forget the keys without any useful local state."""
+        for key, (tokens, expiry, denied) in list(self._local.items()):
+            if (not tokens or expiry < now) and denied < now:
+                del self._local[key]
+
+    def acquire(self, key):
+        """Try to consume a token for the received key.
+
+        :returns: a tuple (allowed, retry_after) where retry_after is
+                  the number of seconds until a new token is available.
+        """
+        now = time.time()
+        with self._lock:
+            tokens, expiry, denied = self._local.get(key, (0, 0, 0))
+            if now < denied:
+                return False, denied - now
+            if tokens >= 1 and now < expiry:
+                self._local[key] = (tokens - 1, expiry, 0)
+                return True, 0
+
+        granted, retry_after = self._queue.take_tokens(
+            "%s:%s" % (self._prefix, key), self._rate, self._burst,
+            self._batch)
+
+        now = time.time()
+        with self._lock:
+            if len(self._local) >= self._max_keys:
+                self._prune(now)
+            if not granted:
+                self._local[key] = (0, 0, now + retry_after)
+                return False, retry_after
+            self._local[key] = (granted - 1, now + self._lease_ttl, 0)
+            return True, 0
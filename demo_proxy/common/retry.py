@@ -0,0 +1,71 @@
+"""Retry policy shared by the upstream and the Redis calls."""
+
+import random
+import time
+
+# The methods which can be sent again without side effects (RFC 7231)
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "TRACE", "PUT",
+                                "DELETE"))
+
+
+class RetryPolicy(object):
+
+    """Decide if a failed call is retried and how long to wait for it.
+
+    The delay grows exponentially with every attempt (capped to
+    `max_backoff`) and is fully jittered, so the clients which failed
+    at the same time don't retry at the same time.
+
+    :param attempts: the maximum number of attempts (including the
+                     first one)
+    :param budget:   the :class:`budget.TokenBudget` spent by the retries
+    :param metrics:  where the retries are counted (as `<name>.retries`,
+                     `<name>.exhausted` and `<name>.throttled`)
+    """
+
+    def __init__(self, attempts=3, backoff=0.05, max_backoff=2.0,
+                 budget=None, metrics=None, name="retry"):
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-positional-arguments
+        self._attempts = attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._budget = budget
+        self._metrics = metrics
+        self._name = name
+
+    @property
+    def attempts(self):
+        """The maximum number of attempts (including the first one)."""
+        return self._attempts
+
+    def _incr(self, counter):
+        """Count the outcome of a failed call."""
+        if self._metrics is not None:
+            self._metrics.incr("%s.%s" % (self._name, counter))
+
+    def deposit(self):
+        """A new call was made (it earns tokens for the retry budget)."""
+        if self._budget is not None:
+            self._budget.deposit()
+
+    def backoff(self, attempt):
+        """The delay before the received attempt (full jitter)."""
+        ceiling = min(self._max_backoff, self._backoff * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def retry(self, attempt):
+        """Wait before retrying, if `attempt` failed attempts allow it.
+
+        :returns: False when the call should not be retried.
+        """
+        if attempt >= self._attempts:
+            self._incr("exhausted")
+            return False
+        if self._budget is not None and not self._budget.spend():
+            self._incr("throttled")
+            return False
+
+        self._incr("retries")
+        time.sleep(self.backoff(attempt))
+        return True
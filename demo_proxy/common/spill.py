@@ -0,0 +1,153 @@
+"""Buffering of the upstream bodies, spilling the large ones to disk."""
+
+import mmap
+import tempfile
+import threading
+import time
+
+import six
+
+# The size of the chunks read from the upstream
+CHUNK_SIZE = 64 * 1024
+
+
+class MemoryBudget(object):
+
+    """The number of body bytes a process is allowed to keep in memory."""
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._used = 0
+        self._lock = threading.Condition()
+
+    @property
+    def limit(self):
+        """The number of bytes that can be reserved."""
+        return self._limit
+
+    @property
+    def used(self):
+        """The number of bytes currently reserved."""
+        return self._used
+
+    def reserve(self, size, timeout=0):
+        """Try to reserve `size` bytes.
+
+        :param timeout: how many seconds to wait for the bytes to be
+                        given back by the others, when there is no room
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while self._used + size > self._limit:
+                remaining = deadline - time.time()
+                if size > self._limit or remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            self._used += size
+            return True
+
+    def release(self, size):
+        """Give back `size` bytes."""
+        with self._lock:
+            self._used -= size
+            self._lock.notify_all()
+
+
+class Body(object):
+
+    """A response body kept either in memory or in a mapped temporary file.
+
+    The body should be closed once it was sent, in order to give back
+    the memory reserved or to remove the temporary file.
+    """
+
+    def __init__(self, data=b"", budget=None, reserved=0, spill_file=None):
+        self._data = data
+        self._budget = budget
+        self._reserved = reserved
+        self._file = spill_file
+        self._map = None
+        if spill_file is not None:
+            spill_file.flush()
+            spill_file.seek(0, 2)
+            size = spill_file.tell()
+            if size:
+                self._map = mmap.mmap(spill_file.fileno(), size,
+                                      access=mmap.ACCESS_READ)
+
+    @property
+    def spilled(self):
+        """Whether the body was written to disk."""
+        return self._file is not None
+
+    def __len__(self):
+        if self._file is not None:
+            return len(self._map) if self._map is not None else 0
+        return len(self._data)
+
+    def getbuffer(self):
+        """Return the body as a buffer, without copying it."""
+        if self._file is not None:
+            if self._map is None:
+                return memoryview(b"")
+            if six.PY2:
+                # The mmap objects don't support the new buffer protocol
+                return memoryview(self._map[:])
+            return memoryview(self._map)
+        return memoryview(self._data)
+
+    def read(self):
+        """Return a copy of the body as bytes."""
+        return self.getbuffer().tobytes()
+
+    def close(self):
+        """Release the resources used by the body."""
+        if self._budget is not None and self._reserved:
+            self._budget.release(self._reserved)
+            self._reserved = 0
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+
+
+def read(chunks, budget, threshold):
+    """Collect the received chunks, spilling them to disk when too large.
+
+    The body stays in memory while it is smaller than `threshold` and
+    there is room for it in the memory budget of the process.
+
+    :param chunks: an iterable of bytes (e.g. a streamed response body)
+    """
+    buffered = []
+    reserved = 0
+    spill_file = None
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+
+            if spill_file is None:
+                size = reserved + len(chunk)
+                if size <= threshold and budget.reserve(len(chunk)):
+                    buffered.append(chunk)
+                    reserved = size
+                    continue
+
+                spill_file = tempfile.TemporaryFile(prefix="demo-proxy-")
+                for item in buffered:
+                    spill_file.write(item)
+                buffered = []
+                budget.release(reserved)
+                reserved = 0
+            spill_file.write(chunk)
+    except Exception:
+        budget.release(reserved)
+        if spill_file is not None:
+            spill_file.close()
+        raise
+
+    if spill_file is not None:
+        return Body(spill_file=spill_file)
+    return Body(b"".join(buffered), budget, reserved)
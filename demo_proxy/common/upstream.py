@@ -0,0 +1,335 @@
+"""Client sending the requests of the web workers to the upstreams.
+
+Every call is guarded by the circuit breaker and the concurrency limit
+of its upstream. The failed calls are retried according to the retry
+policy and the slow idempotent ones are hedged on a second upstream
+(within the hedge budget). The bodies are buffered in memory or
+spilled to disk (see :mod:`demo_proxy.common.spill`).
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+from six.moves import http_client
+from six.moves import http_cookiejar
+from six.moves import queue
+import requests
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+
+from demo_proxy.common import exception
+from demo_proxy.common import hedge
+from demo_proxy.common import retry
+from demo_proxy.common import spill
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.StreamHandler())
+
+# The bodies of the responses generated instead of the upstream's
+FAILED = "Upstream request failed."
+TIMED_OUT = "Upstream request timed out."
+
+
+class Response(object):
+
+    """The response of an upstream (or the one generated instead of it).
+
+    :ivar: headers: the headers as received from the upstream (a
+                    case-insensitive mapping)
+    :ivar: body:    a :class:`spill.Body` or, for the generated
+                    responses, the message
+    """
+
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @classmethod
+    def synthetic(cls, status, message):
+        """Create a response generated by the client itself."""
+        return cls(status, {"Content-Type": "text/plain"}, message)
+
+    @classmethod
+    def failed(cls):
+        """Create the response of a failed upstream call."""
+        return cls.synthetic("502 Bad Gateway", FAILED)
+
+    @classmethod
+    def timed_out(cls):
+        """Create the response of an upstream call without time left."""
+        return cls.synthetic("504 Gateway Timeout", TIMED_OUT)
+
+    def close(self):
+        """Release the resources used by the body."""
+        if isinstance(self.body, spill.Body):
+            self.body.close()
+
+
+class UpstreamClient(object):
+
+    """Send the requests to a pool of upstreams.
+
+    :param upstreams:        the :class:`breaker.UpstreamPool` used
+    :param timeout:          the (connect, read) timeouts of a call
+    :param retry_policy:     decides which failed calls are retried
+    :param memory:           the :class:`spill.MemoryBudget` of the bodies
+    :param spill_threshold:  the size of the bodies written to disk
+    :param hedge_percentile: the percentile of the recent latencies after
+                             which a call is hedged (0 disables hedging)
+    :param hedge_budget:     the :class:`budget.TokenBudget` of the hedges
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, upstreams, timeout, retry_policy, memory,
+                 spill_threshold, metrics, hedge_percentile=0,
+                 hedge_budget=None):
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-positional-arguments
+        self._upstreams = upstreams
+        self._timeout = timeout
+        self._retry = retry_policy
+        self._memory = memory
+        self._spill_threshold = spill_threshold
+        self._metrics = metrics
+        self._hedge_percentile = hedge_percentile
+        self._hedge_budget = hedge_budget
+        self._latency = hedge.LatencyTracker()
+        self._hedge_lock = threading.Lock()
+        # The longest an attempt is expected to take, with its retries
+        self._attempt_timeout = retry_policy.attempts * sum(timeout)
+        self._session = self._create_session(
+            len(upstreams), max(item.max_concurrent for item in upstreams))
+
+    @staticmethod
+    def _create_session(upstreams_count, pool_size):
+        """Create the session shared by all the workers.
+
+        The connections to every upstream are kept alive and reused.
+        The cookies set by the upstreams are never stored, since the
+        session is shared by all the clients.
+        """
+        session = requests.Session()
+        session.cookies.set_policy(
+            http_cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=upstreams_count, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def warm_up(self, connections):
+        """Open the keep-alive connections to the upstreams.
+
+        A few HEAD requests are sent concurrently to every upstream,
+        so the first calls don't pay for the connection setup.
+        """
+        def _connect(url):
+            try:
+                self._session.head(url, timeout=self._timeout)
+            except (requests.RequestException,
+                    urllib3_exceptions.HTTPError) as exc:
+                LOG.warning("Failed to warm up the connection to %s: %s",
+                            url, exc)
+
+        threads = []
+        for upstream in self._upstreams:
+            for _ in range(connections):
+                thread = threading.Thread(target=_connect,
+                                          args=(upstream.url,),
+                                          name="warm-up")
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def _connect_failure(exc):
+        """Check if the connection to the upstream was not established.
+
+        In that case the request didn't reach the upstream, so it can
+        be sent again no matter its method.
+        """
+        if isinstance(exc, requests.ConnectTimeout):
+            return True
+        reason = exc.args[0] if exc.args else None
+        reason = getattr(reason, "reason", reason)
+        return isinstance(reason, urllib3_exceptions.ConnectTimeoutError)
+
+    def _timeouts(self, deadline):
+        """The (connect, read) timeouts of a call ending by the deadline."""
+        remaining = max(deadline - time.time(), 0.001)
+        return tuple(min(timeout, remaining) for timeout in self._timeout)
+
+    def _attempt(self, request, upstream, deadline):
+        """Send the request to the upstream and return its response.
+
+        The failed calls are retried on the next upstream according to
+        the retry policy: the idempotent requests after any failure,
+        the other ones only when the connection was not established.
+        Nothing is sent once the deadline has passed, since nobody
+        waits for the response anymore.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            if time.time() >= deadline:
+                LOG.warning("Request %s expired before attempt %d",
+                            request.uuid, attempt)
+                self._metrics.incr("expired")
+                return Response.timed_out()
+            try:
+                return self._send(request, upstream, deadline)
+            except (requests.RequestException,
+                    urllib3_exceptions.HTTPError) as exc:
+                LOG.error("Upstream %s failed for %s: %s",
+                          upstream.url, request.uuid, exc)
+                retryable = self._connect_failure(exc)
+                if request.method in retry.IDEMPOTENT_METHODS:
+                    retryable = True
+                if not retryable or not self._retry.retry(attempt):
+                    return Response.failed()
+            upstream = self._upstreams.choose(upstream)
+
+    def _send(self, request, upstream, deadline):
+        """Send the request to the upstream once (until the deadline).
+
+        :raises: the errors of the upstream call.
+        """
+        try:
+            upstream.acquire()
+        except (exception.CircuitOpen,
+                exception.ConcurrencyLimitExceeded) as exc:
+            LOG.warning("Request %s rejected: %s", request.uuid, exc)
+            return Response.synthetic("503 Service Unavailable", str(exc))
+
+        success = False
+        start = time.time()
+        # Forward the encodings accepted by the client, so the body
+        # can be sent to the client exactly as received from upstream.
+        headers = {"Accept-Encoding":
+                   request.headers.get("Accept-Encoding") or "identity"}
+        try:
+            response = self._session.request(
+                request.method, upstream.url, headers=headers, stream=True,
+                timeout=self._timeouts(deadline))
+            with contextlib.closing(response):
+                # Nothing should fail once the body is read, since its
+                # memory is released only when the response is sent.
+                status = "%d %s" % (
+                    response.status_code,
+                    http_client.responses.get(response.status_code,
+                                              "Unknown"))
+                body = spill.read(
+                    response.raw.stream(spill.CHUNK_SIZE,
+                                        decode_content=False),
+                    self._memory, self._spill_threshold)
+            success = response.status_code < 500
+        finally:
+            upstream.release(success)
+
+        if success:
+            self._latency.record(time.time() - start)
+        if body.spilled:
+            self._metrics.incr("spilled")
+            self._metrics.incr("spilled.bytes", len(body))
+        return Response(status, response.headers, body)
+
+    def fetch(self, request):
+        """Send the request upstream, hedging it if it is too slow.
+
+        The idempotent requests which didn't get a response within the
+        configured percentile of the recent latencies are sent to a
+        second upstream as well (within the hedge budget). The first
+        successful response wins.
+
+        :param request: the request sent (its method, its headers, its
+                        UUID and its deadline are used)
+        """
+        deadline = time.time() + self._attempt_timeout
+        if request.deadline:
+            deadline = min(deadline, request.deadline)
+        upstream = self._upstreams.choose()
+        self._retry.deposit()
+        self._hedge_budget.deposit()
+        delay = None
+        if self._hedge_percentile and len(self._upstreams) > 1:
+            if request.method in ("GET", "HEAD"):
+                delay = self._latency.percentile(self._hedge_percentile)
+        if delay is None:
+            return self._attempt(request, upstream, deadline)
+
+        results = queue.Queue()
+        attempts = {"done": False}
+        self._start_attempt(request, upstream, deadline, results, attempts,
+                            "primary")
+        try:
+            response = results.get(timeout=delay)[1]
+        except queue.Empty:
+            response = None
+            # A hedge would not finish in time
+            late = time.time() + delay >= deadline
+            if late or not self._hedge_budget.spend():
+                response = self._wait_attempt(request, results, deadline)[1]
+
+        if response is None:
+            LOG.info("Hedging request %s after %.3fs", request.uuid, delay)
+            self._metrics.incr("hedged")
+            self._start_attempt(request, self._upstreams.choose(upstream),
+                                deadline, results, attempts, "hedge")
+            name, response = self._wait_attempt(request, results, deadline)
+            if name != "timeout" and response.status.startswith("5"):
+                # Give a chance to the other attempt
+                response.close()
+                name, response = self._wait_attempt(request, results,
+                                                    deadline)
+            if name == "hedge":
+                self._metrics.incr("hedge.won")
+
+        with self._hedge_lock:
+            # The responses of the losing attempts are not needed
+            attempts["done"] = True
+            while not results.empty():
+                results.get()[1].close()
+        return response
+
+    @staticmethod
+    def _wait_attempt(request, results, deadline):
+        """Wait for the next attempt to finish (until the deadline).
+
+        :returns: a tuple (name, response); the response is a synthetic
+                  504 when no attempt finished in time.
+        """
+        try:
+            return results.get(timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+            LOG.error("No attempt finished in time for %s", request.uuid)
+            return "timeout", Response.timed_out()
+
+    def _start_attempt(self, request, upstream, deadline, results,
+                       attempts, name):
+        """Send the request to the upstream in a separate thread."""
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-positional-arguments
+        def _attempt():
+            try:
+                response = self._attempt(request, upstream, deadline)
+            except Exception:   # pylint: disable=broad-except
+                LOG.exception("The %s attempt failed for %s",
+                              name, request.uuid)
+                self._metrics.incr("failed")
+                response = Response.failed()
+            with self._hedge_lock:
+                if not attempts["done"]:
+                    results.put((name, response))
+                    return
+            response.close()
+
+        attempt = threading.Thread(target=_attempt, name=name)
+        attempt.setDaemon(True)
+        attempt.start()
@@ -8,7 +8,9 @@ import time
 import six
 import redis
 
+from demo_proxy.common import budget
 from demo_proxy.common import exception
+from demo_proxy.common import retry
 
 ATTEMPTS = 3
 RETRY_INTERVAL = 0.1
@@ -18,12 +20,15 @@ class RedisConnection(object):
 
     """High level wrapper over the redis data structures operations."""
 
-    def __init__(self, host, port, database):
+    def __init__(self, host, port, database, retry_policy=None):
         """Instantiates objects able to store and retrieve data."""
         self._rcon = None
         self._host = host
         self._port = port
         self._db = database
+        self._retry = retry_policy or retry.RetryPolicy(
+            ATTEMPTS, RETRY_INTERVAL,
+            budget=budget.TokenBudget(0.1, full=True), name="redis")
         self.refresh()
 
     def _connect(self):
@@ -38,21 +43,26 @@ class RedisConnection(object):
 
         return rcon
 
-    def refresh(self, tries=3):
-        """Re-establish the connection only if is dropped."""
-        for _ in range(tries):
+    def refresh(self):
+        """Re-establish the connection only if is dropped.
+
+        The connection attempts follow the retry policy (with backoff
+        between them).
+        """
+        self._retry.deposit()
+        attempt = 0
+        while True:
             try:
-                if not self._rcon or not self._rcon.ping():
-                    self._rcon = self._connect()
-                else:
-                    break
+                if self._rcon and self._rcon.ping():
+                    return True
             except redis.ConnectionError:
                 pass
-        else:
-            raise exception.DemoProxyException(
-                "Failed to connect to Redis Server.")
 
-        return True
+            if attempt and not self._retry.retry(attempt):
+                raise exception.DemoProxyException(
+                    "Failed to connect to Redis Server.")
+            attempt += 1
+            self._rcon = self._connect()
 
     @property
     def rcon(self):
@@ -1,10 +1,15 @@
 """Server-like task scheduler and processor."""
 import abc
+import logging
+import signal
 import time
 import threading
 
 import six
 
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.StreamHandler())
+
 
 @six.add_metaclass(abc.ABCMeta)
 class Worker(object):
@@ -45,15 +50,30 @@ class Worker(object):
 @six.add_metaclass(abc.ABCMeta)
 class ConcurrentWorker(Worker):
 
-    """Contract class for all the concurrent workers."""
+    """Contract class for all the concurrent workers.
+
+    On SIGTERM the worker drains: no new tasks are fetched, the tasks
+    which didn't start yet are handed back (see :meth:`_requeue_tasks`)
+    and the tasks in progress get `drain_timeout` seconds to finish.
+    On SIGHUP the workers are replaced one by one, each of them after
+    finishing its current task (see :meth:`_retiring`).
+
+    Every worker keeps processing tasks until :meth:`_get_task` returns
+    None (when the worker is stopped or retired).
+    """
+
+    # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, delay=0.1, workers_count=2):
+    def __init__(self, delay=0.1, workers_count=2, drain_timeout=30):
         super(ConcurrentWorker, self).__init__()
         self._delay = delay
         self._workers_count = workers_count     # desired number of workers
         self._workers = []                      # workers as objects
         self._manager = None                    # who supervises the workers
         self._stop_event = threading.Event()
+        self._drain_timeout = drain_timeout
+        self._generation = 0                    # incremented on every reload
+        self._generations = {}                  # the generation of a worker
 
     @abc.abstractmethod
     def _put_task(self, task):
@@ -75,6 +95,26 @@ class ConcurrentWorker(Worker):
         """Create a custom worker and return its object."""
         pass
 
+    def _requeue_tasks(self):
+        """Hand back the tasks which were not started yet."""
+        pass
+
+    def _warm_up(self):
+        """Prepare the resources used by the workers (e.g. connections).
+
+        Executed before the workers are started.
+        """
+        pass
+
+    def _retiring(self):
+        """Check if the current worker should stop after its task.
+
+        The workers started before the last reload are retired.
+        """
+        generation = self._generations.get(threading.current_thread(),
+                                           self._generation)
+        return generation != self._generation
+
     def _manage_workers(self):
         """Maintain a desired number of workers up."""
         while not self._stop_event.is_set():
@@ -82,6 +122,7 @@ class ConcurrentWorker(Worker):
             for worker in self._workers[:]:
                 if not worker.is_alive():
                     self._workers.remove(worker)
+                    self._generations.pop(worker, None)
 
             # Check if all the workers are running
             if len(self._workers) == self._workers_count:
@@ -89,17 +130,35 @@ class ConcurrentWorker(Worker):
                 continue
 
             # Create a new worker
+            generation = self._generation
             worker = self._start_worker()
+            self._generations[worker] = generation
             self._workers.append(worker)
 
     def interrupted(self):
         """What to execute when keyboard interrupts arrive."""
         self._stop_event.set()
 
+    def terminate(self, signum=None, frame=None):
+        """Stop fetching new tasks and drain the current ones."""
+        # pylint: disable=unused-argument
+        LOG.info("Draining the workers (timeout: %ss)", self._drain_timeout)
+        self._stop_event.set()
+
+    def reload(self, signum=None, frame=None):
+        """Replace the workers once they finish their current task."""
+        # pylint: disable=unused-argument
+        LOG.info("Replacing the workers")
+        self._generation += 1
+
     def prologue(self):
         """Start a parallel supervisor."""
         super(ConcurrentWorker, self).prologue()
-        self._manager = threading.Thread(target=self._manage_workers)
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGHUP, self.reload)
+        self._warm_up()
+        self._manager = threading.Thread(target=self._manage_workers,
+                                         name="supervisor")
         self._manager.start()
 
     def run(self):
@@ -110,16 +169,24 @@ class ConcurrentWorker(Worker):
                 # Adding task in the processing queue
                 for task in self._task_generator():
                     self._put_task(task)
+                    if self._stop_event.is_set():
+                        break
                 time.sleep(self._delay)
         except KeyboardInterrupt:
             self.interrupted()
         self.epilogue()
 
     def epilogue(self):
-        """Wait for that supervisor and its workers."""
+        """Wait for that supervisor and drain its workers."""
         self._manager.join()
+        self._requeue_tasks()
+
+        deadline = time.time() + self._drain_timeout
         for worker in self._workers:
-            if worker.is_alive():
-                worker.join()
+            worker.join(max(deadline - time.time(), 0))
+        busy = [worker for worker in self._workers if worker.is_alive()]
+        if busy:
+            LOG.warning("%d workers didn't finish their tasks in %ss",
+                        len(busy), self._drain_timeout)
 
         super(ConcurrentWorker, self).epilogue()
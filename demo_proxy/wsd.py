@@ -1,180 +1,580 @@
 """Web Server Dispach Services."""
+# pylint: disable=too-many-lines
 from __future__ import print_function
 
-import uuid
+import base64
+import binascii
+import bisect
+import functools
+import hashlib
+import uuid as uuid_module
 import json
 import logging
+import math
+import os
+import socket
 import time
 import threading
+import zlib
 
-from six.moves import http_client
 from six.moves import queue
 import gunicorn.app.base
 from gunicorn.six import iteritems
-import requests
 
+from demo_proxy.common import admission
+from demo_proxy.common import breaker
+from demo_proxy.common import budget
+from demo_proxy.common import capture
+from demo_proxy.common import channel
+from demo_proxy.common import dns
+from demo_proxy.common import metrics
+from demo_proxy.common import profiler
+from demo_proxy.common import queue as demo_proxy_queue
+from demo_proxy.common import ratelimit
+from demo_proxy.common import retry
+from demo_proxy.common import spill
+from demo_proxy.common import upstream
 from demo_proxy.common import worker as demo_proxy_worker
 
 
 LOG = logging.getLogger(__name__)
 LOG.addHandler(logging.StreamHandler())
 
+# Headers meaningful only for a single connection (RFC 7230, 6.1)
+HOP_BY_HOP = frozenset((
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "trailers", "transfer-encoding", "upgrade",
+    "proxy-connection",
+))
+# The header used by the clients for marking the retried requests
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# Content types worth compressing for the clients
+COMPRESSIBLE = ("text/", "application/json", "application/javascript",
+                "application/xml", "image/svg+xml")
+# The memory used while a body is serialized for the remote queue, as a
+# multiple of its size (the bytes, the base64 text, the JSON document
+# and the encoded payload)
+QUEUE_COPIES = 4
+
 
 class _HTTPHeaders(object):
-    """Container for HTTP Headers."""
+    """Container for HTTP Headers.
+
+    The headers are kept in a flat list (name, value, name, value, ...)
+    and looked up case-insensitively. The same list is used when the
+    headers are serialized.
+    """
+
+    __slots__ = ('_items',)
 
-    def __init__(self):
-        self._items = {}
+    def __init__(self, items=None):
+        self._items = items if items is not None else []
+
+    def _index(self, key):
+        """Get the position of the received header (or -1)."""
+        key = key.lower()
+        items = self._items
+        for index in range(0, len(items), 2):
+            if items[index].lower() == key:
+                return index
+        return -1
 
     def __getitem__(self, key):
         """Get specific item form row"""
-        return self._items[key]
+        index = self._index(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._items[index + 1]
 
     def __setitem__(self, key, value):
         """Set specific item in specific row"""
-        self._items[key] = value
+        index = self._index(key)
+        if index < 0:
+            self._items.extend((key, value))
+        else:
+            self._items[index + 1] = value
 
     def __delitem__(self, key):
         """Delete specifc item from row"""
-        del self._items[key]
+        index = self._index(key)
+        if index < 0:
+            raise KeyError(key)
+        del self._items[index:index + 2]
+
+    def __contains__(self, key):
+        return self._index(key) >= 0
+
+    def __iter__(self):
+        return iter(self._items[::2])
+
+    def __len__(self):
+        return len(self._items) // 2
+
+    def get(self, key, default=None):
+        """Get specific item from row (if available)."""
+        index = self._index(key)
+        return default if index < 0 else self._items[index + 1]
+
+    def items(self):
+        """Return the (name, value) pairs."""
+        return list(zip(self._items[::2], self._items[1::2]))
+
+    def discard(self, names):
+        """Remove all the headers with the received (lowercase) names."""
+        items = self._items
+        self._items = [item for index in range(0, len(items), 2)
+                       if items[index].lower() not in names
+                       for item in items[index:index + 2]]
 
     def raw_data(self):
         """Dump the raw content of the current object."""
-        return self._items.copy()
+        return self._items
 
     def to_json(self):
         """Dump the headers as JSON file."""
         return json.dumps(self._items)
 
+    @classmethod
+    def from_raw_data(cls, data):
+        """Create a new object from the raw content (list or dict)."""
+        if isinstance(data, cls):
+            return data
+        if isinstance(data, dict):
+            return cls([item for pair in data.items() for item in pair])
+        return cls(data)
+
     @classmethod
     def from_json(cls, data):
         """Dump the current object as JSON file."""
-        headers = cls()
-        raw_headers = json.load(data)
-        for key in raw_headers:
-            headers[key.title()] = raw_headers[key]
-        return headers
+        return cls.from_raw_data(json.loads(data))
 
     @classmethod
     def from_environ(cls, environ):
         """Create a new object from the Gunicorn environ."""
-        headers = cls()
+        items = []
         for key in environ:
             if key.startswith("HTTP_"):
-                header = key.replace("HTTP_", "").replace("_", "-")
-                headers[header.title()] = environ[key]
-        return headers
+                header = key[5:].replace("_", "-")
+                items.extend((header.title(), environ[key]))
+        return cls(items)
 
     @classmethod
     def from_response(cls, http_response):
-        """Create a new object from the requests.response."""
-        headers = cls()
-        for key in http_response.headers:
-            headers[key] = http_response.headers[key]
-        return headers
+        """Create a new object from the requests.response.
 
+        The hop-by-hop headers (including the ones listed in the
+        Connection header) are not copied.
+        """
+        skip = set(HOP_BY_HOP)
+        for token in http_response.headers.get("Connection", "").split(","):
+            skip.add(token.strip().lower())
 
-class _HTTPObject(object):
-    """Simple wrapper over the HTTP request/response."""
+        items = []
+        for key, value in http_response.headers.items():
+            if key.lower() not in skip:
+                items.extend((key, value))
+        return cls(items)
 
-    def __init__(self, **fields):
-        self._data = {}
-        white_list = ('method', 'uri', 'path', 'query',
-                      'headers', 'body', 'uuid')
 
-        for key in white_list:
-            self._data[key] = fields[key] if key in fields else None
-        self._data['uuid'] = self._data['uuid'] or str(uuid.uuid4())
+class _HTTPObject(object):
+    """Simple wrapper over the HTTP request/response.
+
+    The UUID is stored in its binary form (16 bytes) and formatted
+    only when required.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    _FIELDS = ('method', 'uri', 'path', 'query', 'body', 'timestamp',
+               'reply_to', 'reply_queue')
+    __slots__ = _FIELDS + ('_headers', '_uuid')
+
+    def __init__(self, headers=None, uuid=None, method=None, uri=None,
+                 path=None, query=None, body=None, timestamp=None,
+                 reply_to=None, reply_queue=None, **_unknown):
+        # The unknown fields (sent by other versions) are ignored.
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-positional-arguments
+        self.method = method
+        self.uri = uri
+        self.path = path
+        self.query = query
+        self.body = body
+        self.timestamp = timestamp or time.time()
+        self.reply_to = reply_to
+        self.reply_queue = reply_queue
+        self._headers = (_HTTPHeaders.from_raw_data(headers)
+                         if headers is not None else None)
+        if uuid is None:
+            self._uuid = uuid_module.uuid4().bytes
+        elif isinstance(uuid, bytes) and len(uuid) == 16:
+            self._uuid = uuid
+        else:
+            self._uuid = binascii.unhexlify(uuid.replace("-", ""))
 
     @property
     def uuid(self):
         """Get the UUID for the current object."""
-        return self._data.get('uuid')
+        value = binascii.hexlify(self._uuid).decode()
+        return "-".join((value[:8], value[8:12], value[12:16],
+                         value[16:20], value[20:]))
 
     @property
     def headers(self):
         """Get the request headers."""
-        headers = self._data.get('headers')
-        return headers if headers else {}
-
-    @property
-    def body(self):
-        """Get the request body."""
-        return self._data.get('body')
-
-    @property
-    def method(self):
-        """Return the HTTP method used."""
-        return self._data.get('method')
-
-    @property
-    def uri(self):
-        """Return the raw URI."""
-        return self._data.get('uri')
-
-    @property
-    def query(self):
-        """Return the query string."""
-        return self._data.get('query')
+        if self._headers is None:
+            self._headers = _HTTPHeaders()
+        return self._headers
 
     @property
-    def path(self):
-        """Return the request path."""
-        return self._data.get('path')
-
-    def to_json(self):
-        """Dump object as JSON file."""
-        data = self._data.copy()
-        if isinstance(data['headers'], _HTTPHeaders):
-            data['headers'] = data['headers'].raw_data()
+    def content(self):
+        """Get the request body as bytes."""
+        body = self.body or b''
+        if isinstance(body, spill.Body):
+            body = body.read()
+        elif not isinstance(body, bytes):
+            body = body.encode()
+        return body
+
+    def _raw_data(self):
+        """The fields of the current object, ready to be serialized."""
+        data = {key: getattr(self, key) for key in self._FIELDS}
+        data['uuid'] = self.uuid
+        data['headers'] = (self._headers.raw_data()
+                           if self._headers is not None else None)
+        return data
+
+    def to_json(self, body=True):
+        """Dump object as JSON file.
+
+        A binary body (which is not valid UTF-8) is base64 encoded.
+
+        :param body: whether the body should be included (it can be
+                     sent separately)
+        """
+        data = self._raw_data()
+        if not body:
+            data['body'] = None
+        elif isinstance(data['body'], spill.Body):
+            data['body'] = data['body'].read()
+        if isinstance(data['body'], bytes):
+            try:
+                data['body'] = data['body'].decode("utf-8")
+            except UnicodeDecodeError:
+                data['body'] = base64.b64encode(data['body']).decode()
+                data['body_encoding'] = "base64"
         return json.dumps(data)
 
     @classmethod
     def from_json(cls, data):
         """Create a new object from JSON file."""
         arguments = json.loads(data.decode())
+        if arguments.pop('body_encoding', None) == "base64":
+            arguments['body'] = base64.b64decode(arguments['body'])
         return cls(**arguments)
 
 
 class _HTTPRequest(_HTTPObject):
-    """Simple wrapper over HTTP request."""
+    """Simple wrapper over HTTP request.
+
+    :ivar: idempotency_key: The idempotency key of the request, scoped
+                            to its client (set by the server).
+    :ivar: deadline:        When the server stops waiting for the
+                            response (set by the server).
+    """
+
+    _FIELDS = _HTTPObject._FIELDS + ('idempotency_key', 'deadline')
+    __slots__ = ('idempotency_key', 'deadline')
+
+    def __init__(self, idempotency_key=None, deadline=None, **fields):
+        super(_HTTPRequest, self).__init__(**fields)
+        self.idempotency_key = idempotency_key
+        self.deadline = deadline
 
     @classmethod
     def from_environ(cls, environ):
         """Create a new object from Gunicorn environ."""
-        arguments = {
-            'headers': _HTTPHeaders.from_environ(environ),
-            'method': environ.get("REQUEST_METHOD"),
-            'uri': environ.get("RAW_URI"),
-            'path': environ.get("PATH_INFO"),
-            'query': environ.get("QUERY_STRING"),
-        }
-        return cls(**arguments)
+        return cls(
+            headers=_HTTPHeaders.from_environ(environ),
+            method=environ.get("REQUEST_METHOD"),
+            uri=environ.get("RAW_URI"),
+            path=environ.get("PATH_INFO"),
+            query=environ.get("QUERY_STRING"),
+        )
 
 
 class _HTTPResponse(_HTTPObject):
-    """Simple wraper over the HTTP response."""
+    """Simple wraper over the HTTP response.
 
-    def __init__(self, status="200 OK", **fields):
+    :ivar: service_time: How long the worker spent processing the
+                         request (measured on the worker's clock).
+    """
+
+    __slots__ = ('status', 'service_time')
+
+    def __init__(self, status="200 OK", service_time=None, **fields):
         super(_HTTPResponse, self).__init__(**fields)
-        self._data['status'] = status
+        self.status = status
+        self.service_time = service_time
 
-    @property
-    def status(self):
-        """Return the HTTP Response status."""
-        return self._data.get("status")
+    def _raw_data(self):
+        """The fields of the current object, ready to be serialized."""
+        data = super(_HTTPResponse, self)._raw_data()
+        data['status'] = self.status
+        data['service_time'] = self.service_time
+        return data
 
 
 class DemoProxy(gunicorn.app.base.BaseApplication):
     """DemoProxy standalone application."""
 
-    def __init__(self, tasks_queue, delay=0.2, timeout=8, **gunicorn_options):
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, tasks_queue, delay=0.2, timeout=8, max_depth=1000,
+                 target_wait=0.5, admission_interval=1.0,
+                 tenant_header="X-Tenant", priority_header="X-Priority",
+                 tenant_lanes=None,
+                 client_rate=0, client_burst=None, route_rate=0,
+                 route_burst=None, reply_host=None, compress_min_size=0,
+                 capture_dir=None, capture_max_bytes=67108864,
+                 capture_backups=5, idempotency_ttl=86400,
+                 trusted_proxies=None, **gunicorn_options):
+        # pylint: disable=too-many-arguments,too-many-locals
+        # pylint: disable=too-many-positional-arguments
         self._options = gunicorn_options
+        self._trusted_proxies = frozenset(trusted_proxies or ())
+        self._idempotency_ttl = idempotency_ttl
+        self._capture = None
+        if capture_dir:
+            self._capture = capture.CaptureLog(
+                capture_dir, capture_max_bytes, capture_backups)
+        self._compress_min_size = compress_min_size
+        self._reply_host = reply_host
+        self._mailbox = None
+        self._queue_listener = None
+        self._reply_listener = None
+        self._mailbox_pid = None
+        self._mailbox_lock = threading.Lock()
+        self._limiters = []
+        for name, rate, burst in (("client", client_rate, client_burst),
+                                  ("route", route_rate, route_burst)):
+            if rate:
+                self._limiters.append((name, ratelimit.RateLimiter(
+                    tasks_queue, name, rate, burst or rate)))
+        self._tenant_header = tenant_header.title()
+        self._priority_header = priority_header.title()
+        self._tenant_lanes = tenant_lanes or {}
         self._queue = tasks_queue
         self._timeout = timeout
         self._delay = delay
+        self._admission = admission.AdmissionControl(
+            max_depth, target_wait, admission_interval)
+        self._metrics = metrics.Metrics("server")
+        self._depths = ({}, 0)
         super(DemoProxy, self).__init__()
 
+    @property
+    def mailbox(self):
+        """Where all the responses of the current process are delivered.
+
+        Every server process gets its own mailbox and listeners, so they
+        are created only after the workers were forked.
+        """
+        with self._mailbox_lock:
+            if self._mailbox_pid != os.getpid():
+                self._mailbox = channel.Mailbox()
+                name = "%s:%d:%s" % (socket.gethostname(), os.getpid(),
+                                     uuid_module.uuid4().hex[:8])
+                self._queue_listener = channel.QueueListener(
+                    self._queue, self._mailbox, name)
+                if self._reply_host:
+                    self._reply_listener = channel.ReplyListener(
+                        self._reply_host, self._mailbox)
+                self._mailbox_pid = os.getpid()
+        return self._mailbox
+
+    def _queue_depth(self, lane, ttl=0.05):
+        """Return the depth of the remote queue seen by the lane.
+
+        Only the requests waiting in the lane and in the lanes served
+        before it are counted, so the lower lanes are shed first. The
+        depths are cached for `ttl`.
+        """
+        depths, updated_at = self._depths
+        if time.time() - updated_at > ttl:
+            depths = self._queue.depths()
+            self._depths = (depths, time.time())
+        position = demo_proxy_queue.LANES.index(lane)
+        return sum(depths.get(item, 0)
+                   for item in demo_proxy_queue.LANES[:position + 1])
+
+    def _classify(self, request):
+        """Get the priority lane and the tenant for the received request.
+
+        The tenant is taken from the tenant header or, when missing,
+        from the first segment of the request path. The lane is the
+        one configured for the tenant; the priority header can only
+        move the request to a lower lane, so a client cannot starve
+        the other tenants.
+        """
+        headers = request.headers
+        tenant = headers.get(self._tenant_header)
+        if not tenant:
+            tenant = (request.path or "").strip("/").split("/")[0]
+        tenant = tenant or demo_proxy_queue.DEFAULT_TENANT
+
+        lanes = demo_proxy_queue.LANES
+        lane = self._tenant_lanes.get(tenant, demo_proxy_queue.DEFAULT_LANE)
+        requested = headers.get(self._priority_header, "").lower()
+        if requested in lanes and lanes.index(requested) > lanes.index(lane):
+            lane = requested
+        return lane, tenant
+
+    def _client_address(self, environ, request):
+        """The address of the client which sent the request.
+
+        The X-Forwarded-For header is set by the client itself, so it
+        is used only for the hops added by the trusted proxies: the
+        address is the last one which was not added by them.
+        """
+        address = environ.get("REMOTE_ADDR", "unknown")
+        forwarded = [item.strip() for item in
+                     request.headers.get("X-Forwarded-For", "").split(",")
+                     if item.strip()]
+        while address in self._trusted_proxies and forwarded:
+            address = forwarded.pop()
+        return address
+
+    def _limit_key(self, name, environ, request):
+        """The key used by the received rate limiter for the request."""
+        if name == "client":
+            return self._client_address(environ, request)
+        return "%s:/%s" % (request.method,
+                           (request.path or "").strip("/").split("/")[0])
+
+    def _idempotency_key(self, environ, request, tenant):
+        """The idempotency key of the request, scoped to its client.
+
+        The key chosen by a client is unique only for that client, so
+        it is combined with the tenant, the client (its credentials or,
+        without them, its address), the accepted encodings (the body
+        is remembered as encoded by upstream) and the route.
+        """
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key or not self._idempotency_ttl:
+            return None
+
+        credentials = request.headers.get("Authorization")
+        if credentials:
+            client = hashlib.sha256(credentials.encode()).hexdigest()
+        else:
+            client = self._client_address(environ, request)
+        encodings = request.headers.get("Accept-Encoding", "")
+        return ":".join((tenant, client, encodings.replace(" ", "").lower(),
+                         request.method, request.path or "/", key))
+
+    def _rate_limit(self, environ, request, start_response):
+        """Reject the request if any of the rate limits is exceeded."""
+        for name, limiter in self._limiters:
+            allowed, retry_after = limiter.acquire(
+                self._limit_key(name, environ, request))
+            if allowed:
+                continue
+
+            LOG.warning("Request %r %r rate limited by %s (UUID: %s)",
+                        request.method, request.uri, name, request.uuid)
+            self._metrics.incr("rate_limited.%s" % name)
+            self._metrics.flush(self._queue)
+            start_response('429 Too Many Requests', [
+                ("Retry-After", str(int(math.ceil(retry_after)))),
+                ("Content-Type", "text/plain"),
+            ])
+            return [b'Too many requests']
+
+    def _reject(self, start_response, reason):
+        """Reject the request without queueing it."""
+        self._metrics.incr("shed.%s" % reason)
+        start_response('503 Service Unavailable', [
+            ("Retry-After", str(self._admission.retry_after)),
+            ("Content-Type", "text/plain"),
+        ])
+        return [b'Service overloaded']
+
+    def _wait_response(self, request, lane, tenant):
+        """Queue the request and wait for its response."""
+        mailbox = self.mailbox
+        request.reply_queue = self._queue_listener.name
+        if self._reply_listener:
+            request.reply_to = self._reply_listener.address
+
+        mailbox.register(request.uuid)
+        try:
+            self._queue.push(request, lane, tenant)
+            raw_response = mailbox.wait(request.uuid, self._timeout)
+        finally:
+            mailbox.unregister(request.uuid)
+
+        if raw_response:
+            payload, body = raw_response
+            response = _HTTPResponse.from_json(payload)
+            if body is not None:
+                response.body = body
+            return response
+        return None
+
+    def _join(self, request, key):
+        """Claim the idempotency key or wait for the request holding it.
+
+        :returns: a tuple (claimed, response); the response is the one
+                  remembered for the key or None if it didn't arrive
+                  in time.
+        """
+        deadline = time.time() + self._timeout
+        state = self._queue.claim(key, request.uuid, self._idempotency_ttl,
+                                  self._timeout)
+        while state is not None:
+            if state[0] == "done":
+                return False, _HTTPResponse.from_json(state[1])
+            if time.time() >= deadline:
+                return False, None
+            time.sleep(self._delay)
+            state = self._queue.memo(key)
+            if state is None:
+                # The request holding the key failed, try again
+                state = self._queue.claim(key, request.uuid,
+                                          self._idempotency_ttl,
+                                          self._timeout)
+        return True, None
+
+    def _compress(self, environ, headers, body):
+        """Compress the body if the client accepts it and upstream didn't.
+
+        The compressed bodies received from upstream are sent to the
+        client unchanged.
+        """
+        if not self._compress_min_size or len(body) < self._compress_min_size:
+            return body
+        if "Content-Encoding" in headers:
+            return body
+        if not headers.get("Content-Type", "").startswith(COMPRESSIBLE):
+            return body
+
+        accepted = {}
+        for item in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+            coding, _, params = item.strip().lower().partition(";")
+            quality = params.strip()
+            accepted[coding.strip()] = quality not in ("q=0", "q=0.0")
+        if not accepted.get("gzip"):
+            return body
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        self._metrics.incr("client_compression.bytes_in", len(body))
+        self._metrics.incr("client_compression.bytes_out", len(compressed))
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+        return compressed
+
     def _dispatch(self, environ, start_response):
         request = _HTTPRequest.from_environ(environ)
         # Overwrite the User Agent in order to avoid issues
@@ -182,35 +582,106 @@ class DemoProxy(gunicorn.app.base.BaseApplication):
         # Overwrite the Accept header in order to keep the headers small
         request.headers["Accept"] = "*/*"
 
+        lane, tenant = self._classify(request)
+        if self._capture:
+            # Recorded before any request is rejected, so the replay
+            # sees the whole offered load.
+            self._capture.record(request.timestamp, lane, tenant,
+                                 request.to_json())
+
+        limited = self._rate_limit(environ, request, start_response)
+        if limited:
+            return limited
+
+        key = self._idempotency_key(environ, request, tenant)
+        request.idempotency_key = key
+        if key:
+            claimed, response = self._join(request, key)
+            if not claimed:
+                return self._replay(environ, start_response, request,
+                                    response)
+
+        admitted, reason = self._admission.admit(
+            self._queue_depth(lane))
+        if not admitted:
+            LOG.warning("Request %r %r rejected: %s (UUID: %s)",
+                        request.method, request.uri, reason, request.uuid)
+            if key:
+                self._queue.settle(key, request.uuid)
+            self._metrics.flush(self._queue)
+            return self._reject(start_response, reason)
+        self._metrics.incr("admitted")
+
         LOG.info("Request %r %r ready for dispach (UUID: %s)",
                  request.method, request.uri, request.uuid)
-        self._queue.push(request)
-        start = time.time()
-        while True:
-            raw_response = self._queue.pop(request)
-            if raw_response:
-                response = _HTTPResponse.from_json(raw_response)
-                break
-
-            if time.time() - start > self._timeout:
-                LOG.error("Request %s timeout.", request.uuid)
-                start_response('504 Gateway Timeout', [])
-                return [b'Something went wrong']
-
-            time.sleep(self._delay)
+        sent_at = time.time()
+        request.deadline = sent_at + self._timeout
+        response = self._wait_response(request, lane, tenant)
+        if response is None:
+            LOG.error("Request %s timeout.", request.uuid)
+            # The request is still waiting in queue (or was lost).
+            self._admission.observe(self._timeout)
+            if key:
+                # Let the retries of the client go through
+                self._queue.settle(key, request.uuid)
+            self._metrics.incr("timeout")
+            self._metrics.flush(self._queue)
+            start_response('504 Gateway Timeout', [])
+            return [b'Something went wrong']
 
         LOG.info("Response received for %r %r (UUID: %s",
                  request.method, request.uri, request.uuid)
-        
-        response_body = response.body.encode()
-        response.headers["Content-Encoding"] = 'plain'
-        response.headers["Content-Length"] = str(len(response_body))
-        start_response(response.status, [(key, response.headers[key])
-                                         for key in response.headers])
+        if response.service_time is not None:
+            # Each duration is measured on a single clock, so the clock
+            # skew between the hosts doesn't matter.
+            elapsed = time.time() - sent_at
+            queue_wait = max(elapsed - response.service_time, 0)
+            self._admission.observe(queue_wait)
+            self._metrics.observe("queue_wait", queue_wait)
+        self._metrics.flush(self._queue)
+        return self._respond(environ, start_response, response)
+
+    def _replay(self, environ, start_response, request, response):
+        """Answer a retried request with the response of the first one."""
+        if response is None:
+            LOG.error("Request %s timeout while waiting for the request "
+                      "with the same idempotency key.", request.uuid)
+            self._metrics.incr("idempotency.timeout")
+            self._metrics.flush(self._queue)
+            start_response('504 Gateway Timeout', [])
+            return [b'Something went wrong']
+
+        LOG.info("Replaying the response for %r %r (UUID: %s)",
+                 request.method, request.uri, request.uuid)
+        self._metrics.incr("idempotency.replayed")
+        self._metrics.flush(self._queue)
+        response.headers["Idempotent-Replayed"] = "true"
+        return self._respond(environ, start_response, response)
+
+    def _respond(self, environ, start_response, response):
+        """Send the response to the client."""
+        headers = response.headers
+        headers.discard(HOP_BY_HOP)
+        response_body = self._compress(environ, headers, response.content)
+        headers["Content-Length"] = str(len(response_body))
+        start_response(response.status, headers.items())
         return iter([response_body])
 
+    @staticmethod
+    def _when_ready(server):
+        """Forward the profiling signal to the workers of the master."""
+        profiler.forward(lambda: list(server.WORKERS))
+
+    @staticmethod
+    def _post_fork(server, worker):
+        """Let the profiler be toggled in the new worker process."""
+        # pylint: disable=unused-argument
+        profiler.install("server")
+
     def load_config(self):
         """The initial setup of the standalone application."""
+        self.cfg.set("when_ready", self._when_ready)
+        self.cfg.set("post_fork", self._post_fork)
         for key, value in iteritems(self._options):
             if value is not None and key in self.cfg.settings:
                 self.cfg.set(key, value)
@@ -223,24 +694,160 @@ class DemoProxy(gunicorn.app.base.BaseApplication):
 class ProxyWorker(demo_proxy_worker.ConcurrentWorker):
     """DemoProxy web worker."""
 
-    def __init__(self, tasks_queue, delay, workers_count):
-        super(ProxyWorker, self).__init__(delay, workers_count)
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, tasks_queue, delay, workers_count, upstreams=None,
+                 upstream_timeout=(3.05, 5), max_concurrent=None,
+                 concurrency_timeout=1.0,
+                 failure_threshold=5, recovery_timeout=30,
+                 tenant_weights=None, batch_size=64, batch_delay=0.0005,
+                 hedge_percentile=0, hedge_budget=0.05,
+                 spill_threshold=1048576, memory_budget=67108864,
+                 drain_timeout=30, dns_ttl=30, warm_connections=2,
+                 upstream_retries=2, retry_budget=0.1):
+        # pylint: disable=too-many-arguments,too-many-locals
+        # pylint: disable=too-many-positional-arguments
+        super(ProxyWorker, self).__init__(delay, workers_count,
+                                          drain_timeout)
         self.queue = queue.Queue()
         self.stop = threading.Event()
         self._task_queue = tasks_queue
+        self._tenant_weights = tenant_weights or {}
+        self._deficits = {}
+        self._cursors = {}
+        self._replies = channel.ReplySender()
+        self._writer = demo_proxy_queue.ResponseWriter(
+            tasks_queue, batch_size, batch_delay, tasks_queue.retry_policy)
+        self._upstream_timeout = upstream_timeout
+        # By default every worker thread can reach the same upstream
+        max_concurrent = max_concurrent or workers_count
+        self._dns_ttl = dns_ttl
+        self._warm_connections = min(warm_connections, max_concurrent)
+        self._metrics = metrics.Metrics("worker")
+        self._memory = spill.MemoryBudget(memory_budget)
+        self._client = upstream.UpstreamClient(
+            breaker.UpstreamPool(
+                upstreams or ["https://example.com"],
+                max_concurrent=max_concurrent,
+                failure_threshold=failure_threshold,
+                recovery_timeout=recovery_timeout,
+                acquire_timeout=concurrency_timeout),
+            upstream_timeout,
+            retry.RetryPolicy(
+                upstream_retries + 1,
+                budget=budget.TokenBudget(retry_budget, full=True),
+                metrics=self._metrics, name="upstream"),
+            self._memory, spill_threshold, self._metrics,
+            hedge_percentile, budget.TokenBudget(hedge_budget))
+        self._id = "%s:%d" % (socket.gethostname(), os.getpid())
+        self._started_at = time.time()
+        self._last_heartbeat = 0
+        self._counters_lock = threading.Lock()
+        self._in_flight = 0
+        self._processed = 0
+
+    def _lane_tasks(self, lane, count):
+        """Get up to `count` tasks from the received lane.
+
+        The tenants are served using deficit round robin: every round
+        each tenant earns its weight (default: 1) in credits and every
+        task retrieved costs one credit. The round is resumed from the
+        same tenant on the next call. The tenants without a positive
+        weight are skipped.
+        """
+        tenants = self._task_queue.tenants(lane)
+        cursor = self._cursors.pop(lane, None)
+        if cursor:
+            position = bisect.bisect_left(tenants, cursor)
+            tenants = tenants[position:] + tenants[:position]
+
+        while tenants and count > 0:
+            for tenant in tenants[:]:
+                if count <= 0:
+                    self._cursors[lane] = tenant
+                    return
+
+                key = (lane, tenant)
+                weight = self._tenant_weights.get(tenant, 1)
+                if not weight > 0:
+                    # Its deficit would never grow enough for a task
+                    tenants.remove(tenant)
+                    continue
+                deficit = self._deficits.get(key, 0)
+                if deficit < 1:
+                    deficit += weight
+                self._deficits[key] = deficit
+                while self._deficits[key] >= 1 and count > 0:
+                    item = self._task_queue.get_request(lane, tenant)
+                    if not item:
+                        # Idle tenants should not accumulate credits
+                        del self._deficits[key]
+                        tenants.remove(tenant)
+                        break
+                    self._deficits[key] -= 1
+                    count -= 1
+                    yield lane, tenant, item
+
+                if self._deficits.get(key, 0) >= 1:
+                    self._cursors[lane] = tenant
+                    return
+
+    def _warm_up(self):
+        """Open the keep-alive connections to the upstreams."""
+        self._client.warm_up(self._warm_connections)
+
+    def prologue(self):
+        """Start the response writer and the workers."""
+        profiler.install("worker")
+        if self._dns_ttl:
+            dns.install(self._dns_ttl)
+        self._writer.start()
+        super(ProxyWorker, self).prologue()
+
+    def epilogue(self):
+        """Wait for the workers and flush the pending responses."""
+        super(ProxyWorker, self).epilogue()
+        self._writer.stop()
 
     def _task_generator(self):
-        """Override this with your custom task generator."""
+        """Get the tasks from the priority lanes according to weights."""
         while not self._stop_event.is_set():
-            if self.queue.qsize() < self._workers_count:
-                item = self._task_queue.get_request()
-                if item:
+            count = self._workers_count - self.queue.qsize()
+            for lane in demo_proxy_queue.LANES:
+                for item in self._lane_tasks(lane, count):
+                    count -= 1
                     yield item
+                if count <= 0:
+                    break
+            self._metrics.flush(self._task_queue)
+            self._heartbeat()
             time.sleep(self._delay)
 
+    def _heartbeat(self, interval=1.0):
+        """Publish the state of the current worker (every `interval`)."""
+        now = time.time()
+        if now - self._last_heartbeat < interval:
+            return
+        self._last_heartbeat = now
+
+        with self._counters_lock:
+            in_flight, processed = self._in_flight, self._processed
+        self._task_queue.heartbeat(self._id, {
+            "threads": self._workers_count,
+            "in_flight": in_flight,
+            "backlog": self.queue.qsize(),
+            "processed": processed,
+            "started_at": self._started_at,
+            "updated_at": now,
+        })
+
     def _get_task(self):
-        """Retrieves a task from the shared queue."""
-        while not self._stop_event.is_set():
+        """Retrieves a task from the shared queue.
+
+        :returns: a (lane, tenant, request) tuple or None when the
+                  worker should stop.
+        """
+        while not self._stop_event.is_set() and not self._retiring():
             try:
                 return self.queue.get_nowait()
             except queue.Empty:
@@ -248,36 +855,154 @@ class ProxyWorker(demo_proxy_worker.ConcurrentWorker):
 
     def _put_task(self, task):
         """Add a new task into the internal queue."""
-        request = _HTTPRequest.from_json(task)
-        self.queue.put(request)
+        lane, tenant, data = task
+        self.queue.put((lane, tenant, _HTTPRequest.from_json(data)))
 
-    def _work(self):
-        request = self._get_task()
-        if not request:
-            print("Invalid request received.")
-            return
+    def _requeue_tasks(self):
+        """Push the tasks which were not started back to the lanes.
 
-        LOG.info("Request recived %r %r (UUID: %s)",
-                 request.method, request.uri, request.uuid)
-        response = requests.request(request.method, "https://example.com")
-        status_code = "%d %s" % (response.status_code,
-                                 http_client.responses[response.status_code])
-
-        http_response = _HTTPResponse(
+        They are added at the end the workers read from, so they are
+        the next ones to be processed.
+        """
+        tasks = []
+        while True:
+            try:
+                tasks.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if tasks:
+            LOG.info("Handing back %d tasks to the remote queue", len(tasks))
+            self._task_queue.requeue(tasks)
+
+    def _fetch(self, request):
+        """Send the request upstream and wrap its response."""
+        try:
+            response = self._client.fetch(request)
+        except Exception:   # pylint: disable=broad-except
+            LOG.exception("Failed to process the request %s", request.uuid)
+            self._metrics.incr("failed")
+            response = upstream.Response.failed()
+        return _HTTPResponse(
             method=request.method,
-            status=status_code,
+            status=response.status,
             headers=_HTTPHeaders.from_response(response),
             uri=request.uri,
             path=request.path,
             query=request.query,
             uuid=request.uuid,
-            body=response.content.decode()
+            body=response.body
         )
-        self._task_queue.set_response(request, http_response)
+
+    def _work(self):
+        """Process the tasks until the worker stops or is retired."""
+        while True:
+            task = self._get_task()
+            if not task:
+                return
+            self._process(task)
+
+    def _process(self, task):
+        """Send the request upstream and its response to the server."""
+        _, _, request = task
+
+        LOG.info("Request recived %r %r (UUID: %s)",
+                 request.method, request.uri, request.uuid)
+        with self._counters_lock:
+            self._in_flight += 1
+        try:
+            started_at = time.time()
+            http_response = self._fetch(request)
+            http_response.service_time = time.time() - started_at
+            try:
+                self._reply(request, http_response)
+                self._memoize(request, http_response)
+            finally:
+                self._release(http_response)
+        finally:
+            with self._counters_lock:
+                self._in_flight -= 1
+                self._processed += 1
+
+    def _reserve_copies(self, http_response):
+        """Reserve the memory used while the response is serialized.
+
+        A body whose copies don't fit in the memory budget reserves all
+        of it, so the largest bodies are serialized one at a time.
+
+        :returns: the number of bytes reserved or None when the budget
+                  was not given back in time.
+        """
+        size = min(len(http_response.body or b"") * QUEUE_COPIES,
+                   self._memory.limit)
+        if self._memory.reserve(size, self._upstream_timeout[1]):
+            return size
+        LOG.warning("No memory left for serializing the response of %s "
+                    "(%d bytes)", http_response.uuid, size)
+        self._metrics.incr("memory_exhausted")
+        return None
+
+    def _reply(self, request, http_response):
+        """Send the response to the server process waiting for it.
+
+        An upstream body is sent over the direct channel straight from
+        its buffer (which can be a mapped file), and copied only when
+        the response goes through the remote queue. The copies are
+        counted in the memory budget until the response is written;
+        when the budget is not given back in time, the response is
+        sent anyway.
+        """
+        body = http_response.body
+        if request.reply_to:
+            if isinstance(body, spill.Body):
+                payload = http_response.to_json(body=False).encode()
+                sent = self._replies.send(request.reply_to, request.uuid,
+                                          payload, body.getbuffer())
+            else:
+                payload = http_response.to_json().encode()
+                sent = self._replies.send(request.reply_to, request.uuid,
+                                          payload)
+            if sent:
+                return
+            LOG.warning("Direct reply to %s failed, falling back to the "
+                        "remote queue (UUID: %s)", request.reply_to,
+                        request.uuid)
+        reserved = self._reserve_copies(http_response) or 0
+        if isinstance(body, spill.Body):
+            # The response writer serializes it later, in another thread
+            http_response.body = body.read()
+            body.close()
+        self._writer.submit(request, http_response,
+                            functools.partial(self._memory.release, reserved))
+
+    def _memoize(self, request, http_response):
+        """Remember the response for the retries of the request.
+
+        The failed requests (5xx) are not remembered, so their retries
+        are sent upstream again. Neither are the responses whose copies
+        could not be reserved in time.
+        """
+        key = request.idempotency_key
+        if not key:
+            return
+        reserved = None
+        if not http_response.status.startswith("5"):
+            reserved = self._reserve_copies(http_response)
+        try:
+            self._task_queue.settle(
+                key, request.uuid,
+                None if reserved is None else http_response)
+        finally:
+            self._memory.release(reserved or 0)
+
+    @staticmethod
+    def _release(http_response):
+        """Release the resources used by the body of the response."""
+        if isinstance(http_response.body, spill.Body):
+            http_response.body.close()
 
     def _start_worker(self):
         """Creates a new thread."""
-        worker = threading.Thread(target=self._work)
+        worker = threading.Thread(target=self._work, name="worker")
         worker.setDaemon(True)
         worker.start()
         return worker
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Guard the start-up time of the command line application.
+
+Builds the command line parser (as `demo_proxy <command> --help` or
+`demo_proxy server stop` would do) in fresh interpreters and checks
+that the heavy subsystems are not imported.
+
+Usage:
+    python tools/bench_import.py [--runs 10] [--max-ms 150]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Modules that should be loaded only when a command really needs them
+HEAVY_MODULES = ("gunicorn", "requests", "redis", "demo_proxy.wsd")
+
+PROBE = """
+import json, runpy, sys
+client = runpy.run_path(%(script)r, run_name="demo_proxy_cli")
+application = client["DemoProxyClient"](%(command_line)r)
+application.prologue()
+heavy = sorted(set(name if name in %(heavy)r else name.split(".")[0]
+                   for name in sys.modules
+                   if name.split(".")[0] in %(heavy)r or name in %(heavy)r))
+print(json.dumps(heavy))
+"""
+
+COMMAND_LINES = (
+    ["server", "stop"],
+    ["worker", "stop"],
+)
+
+
+def _probe(command_line):
+    """Return (seconds, heavy modules) for a fresh interpreter."""
+    code = PROBE % {"script": os.path.join(ROOT, "scripts", "demo_proxy"),
+                    "command_line": command_line,
+                    "heavy": HEAVY_MODULES}
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.time()
+    output = subprocess.check_output([sys.executable, "-c", code], env=env)
+    elapsed = time.time() - start
+    return elapsed, json.loads(output.decode().strip().splitlines()[-1])
+
+
+def _baseline(runs):
+    """The time required for starting an empty interpreter."""
+    start = time.time()
+    for _ in range(runs):
+        subprocess.check_call([sys.executable, "-c", "pass"])
+    return (time.time() - start) / runs
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=150,
+                        help="The maximum start-up overhead accepted.")
+    args = parser.parse_args()
+
+    interpreter = _baseline(args.runs)
+    failed = False
+    for command_line in COMMAND_LINES:
+        timings = []
+        heavy = []
+        for _ in range(args.runs):
+            elapsed, heavy = _probe(command_line)
+            timings.append(elapsed)
+        overhead = (min(timings) - interpreter) * 1000
+        print("%-14s %7.1f ms (over the interpreter start-up)" %
+              (" ".join(command_line), overhead))
+        if heavy:
+            print("  heavy modules imported: %s" % ", ".join(heavy))
+            failed = True
+        if overhead > args.max_ms:
+            print("  slower than %.1f ms" % args.max_ms)
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Measure the memory used by the in-flight request/response objects.
+
+Usage:
+    python tools/bench_objects.py [--count 10000]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from demo_proxy import wsd  # noqa: E402 pylint: disable=wrong-import-position
+
+ENVIRON = {
+    "REQUEST_METHOD": "GET",
+    "RAW_URI": "/tenant/resource?page=2",
+    "PATH_INFO": "/tenant/resource",
+    "QUERY_STRING": "page=2",
+    "HTTP_HOST": "proxy.example.com",
+    "HTTP_USER_AGENT": "curl/7.58.0",
+    "HTTP_ACCEPT": "*/*",
+    "HTTP_ACCEPT_ENCODING": "gzip, deflate",
+    "HTTP_X_TENANT": "tenant",
+    "HTTP_X_FORWARDED_FOR": "10.0.0.1",
+}
+
+
+def _measure(function, count):
+    """Return (bytes, allocations) retained by `count` calls."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [function() for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    del objects
+    return size, blocks
+
+
+def _round_trip():
+    """Serialize a request and parse it back (as the worker does)."""
+    request = wsd._HTTPRequest.from_environ(ENVIRON)
+    return wsd._HTTPRequest.from_json(request.to_json().encode())
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10000)
+    args = parser.parse_args()
+
+    for name, function in (
+            ("from_environ", lambda: wsd._HTTPRequest.from_environ(ENVIRON)),
+            ("json round trip", _round_trip)):
+        size, blocks = _measure(function, args.count)
+        start = time.time()
+        for _ in range(args.count):
+            function()
+        elapsed = time.time() - start
+        print("%-16s %8.1f bytes/object %6.1f allocations/object "
+              "%6.2f us/object" % (name, size / args.count,
+                                   blocks / args.count,
+                                   elapsed / args.count * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Replay the captured traffic through the queue and measure it.
+
+The requests recorded by `demo_proxy server start --capture-dir` are
+pushed in the same lanes, with the same spacing between them (divided
+by --speed, 0 meaning as fast as possible). The workers should be
+started with --upstream pointing to the stub upstream, which answers
+every request after --stub-latency seconds.
+
+Usage:
+    python tools/replay.py capture/capture-*.log [--speed 1]
+        [--stub 8081] [--stub-latency 0.01] [--stub-size 1024]
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+# pylint: disable=wrong-import-position
+from demo_proxy.common import capture  # noqa: E402
+from demo_proxy.common import queue as demo_proxy_queue  # noqa: E402
+from demo_proxy import wsd  # noqa: E402
+
+
+def _start_stub(port, latency, size):
+    """Answer every request after `latency` seconds with `size` bytes."""
+    body = b"x" * size
+
+    class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def _answer(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _answer
+
+        def log_message(self, *args):   # pylint: disable=arguments-differ
+            pass
+
+    class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = _Server(("0.0.0.0", port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name="stub")
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+class _Collector(object):
+
+    """Wait for the responses of the replayed requests."""
+
+    def __init__(self, tasks_queue):
+        self.reply_queue = "replay:%s" % uuid.uuid4().hex[:8]
+        self._queue = tasks_queue
+        self._lock = threading.Lock()
+        self._sent = {}
+        self.latencies = []
+        self.statuses = collections.Counter()
+
+        thread = threading.Thread(target=self._listen, name="collector")
+        thread.setDaemon(True)
+        thread.start()
+
+    @property
+    def pending(self):
+        """The number of requests still waiting for their response."""
+        return len(self._sent)
+
+    def sent(self, key):
+        """A request was pushed in the queue."""
+        with self._lock:
+            self._sent[key] = time.time()
+
+    def _listen(self):
+        while True:
+            for key, payload in self._queue.get_responses(self.reply_queue):
+                now = time.time()
+                with self._lock:
+                    sent_at = self._sent.pop(key, None)
+                if sent_at is None:
+                    continue
+                self.latencies.append(now - sent_at)
+                status = json.loads(payload.decode()).get("status") or ""
+                self.statuses[status.split(" ")[0]] += 1
+
+
+def _percentile(values, percentile):
+    """The received percentile of the sorted values."""
+    index = int(round(percentile / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def _replay(records, tasks_queue, collector, speed):
+    """Push the records, keeping their spacing (divided by speed)."""
+    start = first = None
+    count = 0
+    for timestamp, lane, tenant, payload in records:
+        if first is None:
+            start, first = time.time(), timestamp
+        if speed:
+            delay = start + (timestamp - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        data = json.loads(payload)
+        data.update(uuid=str(uuid.uuid4()), timestamp=time.time(),
+                    reply_queue=collector.reply_queue, reply_to=None)
+        request = wsd._HTTPRequest.from_json(json.dumps(data).encode())
+        collector.sent(request.uuid)
+        tasks_queue.push(request, lane, tenant)
+        count += 1
+    return count, time.time() - (start or time.time())
+
+
+def main():
+    """Replay the captured requests and report the latencies."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("logs", nargs="+",
+                        help="The capture logs (of all the processes).")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="Replay N times faster (0: no delays).")
+    parser.add_argument("--redis-host", default="redis")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-database", type=int, default=0)
+    parser.add_argument("--stub", type=int, default=None,
+                        help="Start a stub upstream on this port.")
+    parser.add_argument("--stub-latency", type=float, default=0.01)
+    parser.add_argument("--stub-size", type=int, default=1024)
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="How long to wait for the last responses.")
+    args = parser.parse_args()
+
+    if args.stub is not None:
+        _start_stub(args.stub, args.stub_latency, args.stub_size)
+        print("Stub upstream listening on port %d" % args.stub)
+
+    tasks_queue = demo_proxy_queue.RedisQueue(
+        args.redis_host, args.redis_port, args.redis_database)
+    collector = _Collector(tasks_queue)
+    count, elapsed = _replay(capture.read_logs(args.logs), tasks_queue,
+                             collector, args.speed)
+
+    deadline = time.time() + args.timeout
+    while collector.pending and time.time() < deadline:
+        time.sleep(0.05)
+
+    latencies = sorted(collector.latencies)
+    print("%d requests replayed in %.2fs (%.1f req/s), %d without response"
+          % (count, elapsed, count / max(elapsed, 0.001), collector.pending))
+    if latencies:
+        report = []
+        for percentile in (50, 90, 99, 99.9):
+            report.append("p%g %.1f" % (
+                percentile, _percentile(latencies, percentile) * 1000))
+        report.append("max %.1f" % (latencies[-1] * 1000))
+        print("latency (ms): " + "  ".join(report))
+    print("statuses: " + "  ".join(
+        "%s: %d" % item for item in sorted(collector.statuses.items())))
+    return 1 if collector.pending else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())